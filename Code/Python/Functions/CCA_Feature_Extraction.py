@@ -1,31 +1,38 @@
 import numpy as np
+from .Canonical_correlation import cca_batch
+from .Reference_signal import reference_signal
 
 # ===================== Feature extraction using Canonical Correlation Analysis (CCA) ========================
-def cca_feature_extraction(data, fs, f_stim, num_channel, num_harmonic):
+def cca_feature_extraction(data, fs, f_stim, num_channel, num_harmonic, dtype=np.float64, chunk_size=None,
+                           out=None):
     """
     =============================== Presented by: Reza Saadatyar (2023-2024) =================================
     ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
     Parameters:
-    - data: EEG data matrix with dimensions (number of samples, number of channels, number of trials).
+    - data: EEG data matrix with dimensions (number of samples, number of channels, number of trials), e.g.,
+    the memory map of an epoch store.
     - fs: Sampling frequency of the EEG data.
     - f_stim: Array of frequencies for stimulation.
     - num_channel: Number of the channel to analyze.
     - num_harmonic: Number of harmonic frequencies for each stimulation frequency.
+    - dtype: Floating point precision of the computation and of the features (np.float64 or np.float32).
+    - chunk_size: Number of trials processed at once (default: all the trials); only one chunk of trials is
+    loaded and decomposed at a time.
+    - out: Optional array (number of trials, number of frequencies * number of components) filled with the
+    features.
+    Output:
+    - features: Canonical correlations with dimensions (number of trials, number of frequencies * number of
+    components), ordered by frequency and then by component (descending), ready for Feature_selections.
     ========================== Flowchart for the cca_feature_extraction function =============================
     Start
     1. Convert the input data to a NumPy ndarray if it's not already.
     2. Transpose the data if it has more columns than rows.
-    3. Define the reference signals based on the stimulation frequencies:
-        - Create an empty list for reference signals.
-        - Generate reference signals for each frequency stimulation.
-        - Stack the sine and cosine components of each harmonic together.
-        - Store the reference signals in the `data_ref` list.
-    4. Perform correlation analysis between the input data and reference signals:
-        - Initialize an empty list for storing correlation coefficients.
-        - Loop through all trials in the input data.
-            - For each trial, calculate the correlation coefficient using Canonical Correlation Analysis (CCA).
-            - Append the correlation coefficients to the `coeff` list.
-        - Stack the correlation coeffi
+    3. Get the reference signals of all stimulation frequencies and their orthonormal basis from the cached
+    reference bank.
+    4. Preallocate the features (number of trials, number of frequencies * number of components) with dtype.
+    5. For each chunk of trials, compute the canonical correlations of all its trials and frequencies at once
+    (cca_batch) and write them into the rows of the chunk.
+    6. Return the features.
     End
     ==========================================================================================================
     """
@@ -35,93 +42,19 @@ def cca_feature_extraction(data, fs, f_stim, num_channel, num_harmonic):
     # Transpose the data if it has more than one dimension and has fewer rows than columns
     data = data.T if data.ndim > 1 and data.shape[0] < data.shape[-1] else data
     # ---------------------------------------- Reference signal ----------------------------------------------
-    data_ref = []
-    time = np.arange(0, data.shape[0]) / fs  # Time vector
-
-    for _, val in enumerate(f_stim): # First loop: frequencies stimulation
-
-        signal_ref = []
-
-        for j in range(1, num_harmonic + 1):  # Generate a reference signal for each frequency stimulation
-            signal_ref.append(np.sin(2 * np.pi * j * val * time))
-            signal_ref.append(np.cos(2 * np.pi * j * val * time))
-
-        data_ref.append(np.stack(signal_ref, axis=1))  # Store data_ref in the data_ref_list
+    # Cached reference bank and its orthonormal basis
+    data_ref, q_ref = reference_signal(fs, data.shape[0], f_stim, num_harmonic, orthonormal=True, dtype=dtype)
     # --------------------------------------- Correlation Analysis -------------------------------------------
-    features = []
-    for i in range(data.shape[-1]): # Loop through all Trials
-        
-        coeff = []
+    num_trial = data.shape[-1]
+    num_channel = np.arange(data.shape[1])[num_channel].reshape(-1)   # Index array (a single channel too)
+    num_x = min(data.shape[0], num_channel.size)                       # Columns of the QR factor Qx
+    shape = (num_trial, q_ref.shape[0] * min(num_x, q_ref.shape[-1]))
+    features = np.empty(shape, dtype=dtype) if out is None else out
+    chunk_size = chunk_size or max(num_trial, 1)
+
+    for start in range(0, num_trial, chunk_size):  # Canonical correlations of each chunk of trials
+        stop = min(start + chunk_size, num_trial)
+        cano_corr = cca_batch(data[..., start:stop], data_ref, num_channel, dtype, q_ref)
+        features[start:stop] = cano_corr.reshape(stop - start, -1)
 
-        for k in range(len(f_stim)):  # Second loop: Calculate CCA for frequencies stimulation
-            coeff.append(cca_analysis(data[:, num_channel, i], data_ref[k]))
-            
-        features.append(np.hstack(coeff))
-    
-    features = np.stack(features)
-    
     return features
-
-
-def cca_analysis(data, data_ref):
-    """
-    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
-    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
-    Canonical Correlation Analysis (CCA)
-    Parameters:
-    - data: EEG data or one set of variables.
-    - data_ref: Reference data or another set of variables.
-    ==================================== Flowchart for the cca function ======================================
-    Start
-    1. Convert data and data_ref to NumPy arrays if they are not already.
-    2. Transpose data and data_ref if they have more than one dimension and fewer rows than columns.
-    3. Concatenate data and data_ref along the second axis if the number of features in data is less than or 
-    equal 
-    to the number of features in data_ref. Otherwise, concatenate data_ref and data.
-    4. Calculate the covariance matrices:
-    a. Extract covariance matrices for each set of variables from the combined covariance matrix.
-    5. Solve the optimization problem using eigenvalue decomposition:
-    a. Ensure numerical stability by adding a small epsilon value to the diagonal of covariance matrices.
-    b. Compute the correlation coefficient matrix using the formula: inv(cy + eps * I) @ cyx @ inv(cx + eps *
-    I) @ cxy.
-    6. Perform eigenvalue decomposition on the correlation coefficient matrix.
-    7. Sort the eigenvalues in descending order.
-    8. Set any small negative eigenvalues to a small positive value, assuming they are due to numerical error.
-    9. Extract and return the sorted canonical correlation coefficients.
-    End
-    ==========================================================================================================
-    """
-    # ---------------------------- Convert data to ndarray if it's not already -------------------------------
-    data = np.array(data) if not isinstance(data, np.ndarray) else data
-    data_ref = np.array(data_ref) if not isinstance(data_ref, np.ndarray) else data_ref
-    
-    # Transpose the data if it has more than one dimension and has fewer rows than columns
-    data, data_ref = [x.T if x.ndim > 1 and x.shape[0] < x.shape[-1] else x for x in [data, data_ref]]
-   
-    # Combine the data and reference data based on their dimensionality
-    xy = np.concatenate((data, data_ref), axis=1) if data.shape[1] <= data_ref.shape[1] else np.concatenate\
-        ((data_ref, data), axis=1)
-    
-    # Calculate covariance matrices
-    covariance = np.cov(xy, rowvar=False)
-    n = min(data.shape[1], data_ref.shape[1])
-    cx = covariance[:n, :n]
-    cy = covariance[n:, n:]
-    cxy = covariance[:n, n:]
-    cyx = covariance[n:, :n]
-    
-    # Solve the optimization problem using eigenvalue decomposition
-    # Adding np.eye(*cy.shape) * eps ensures numerical stability
-    eps = np.finfo(float).eps
-    corr_coef = np.linalg.inv(cy + np.eye(*cy.shape) * eps) @ cyx @ np.linalg.inv(cx + np.eye(*cx.shape) * 
-                                                                                  eps) @ cxy
-    
-    # Eigenvalue decomposition and sorting
-    eig_vals = np.linalg.eigvals(corr_coef)
-    
-    # Set any small negative eigenvalues to zero, assuming they are due to numerical error
-    eig_vals[eig_vals < 0] = 0.0000000000000000000001
-    d_coeff = np.sort(np.real(eig_vals))[::-1]  # Only real parts, sorted in descending order
-    # d_coeff = np.sqrt(np.sort(np.real(eig_vals))[::-1])  # Only real parts, sorted in descending order
-    
-    return d_coeff[:n]  # Return the canonical correlations
\ No newline at end of file
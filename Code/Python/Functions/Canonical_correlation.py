@@ -0,0 +1,149 @@
+import numpy as np
+from functools import lru_cache
+
+# ====================================== Batched canonical correlations ======================================
+def cca_batch(data, data_ref, num_channel=None, dtype=np.float64, q_ref=None):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Canonical correlations between every trial and every reference signal in a few batched calls.
+    Parameters:
+    - data: EEG data matrix with dimensions (number of samples, number of channels, number of trials).
+    - data_ref: Stacked reference signals with dimensions (number of frequencies, number of samples,
+    2 * number of harmonics).
+    - num_channel: Index of the channels to analyze (default: all channels).
+    - dtype: Floating point precision of the computation (np.float64 or np.float32).
+    - q_ref: Precomputed orthonormal basis of data_ref from reference_qr (default: computed and cached).
+    Output:
+    - cano_corr: Canonical correlations with dimensions (number of trials, number of frequencies, number of
+    components), sorted in descending order.
+    ================================= Flowchart for the cca_batch function ===================================
+    Start
+    1. Convert data and data_ref to NumPy arrays if they are not already.
+    2. Transpose the data if it has fewer rows than columns and add a trial axis to a single trial.
+    3. Select the channels and remove the mean of every channel.
+    4. Compute the orthonormal basis Qx of every trial in one batched call (thin QR, truncated at the
+    numerical rank, e.g., for common-average-referenced data using all channels).
+    5. Get the orthonormal basis Qy of every reference signal from the cache (computed once).
+    6. Compute Qx^T Qy for all trials and frequencies in a single matrix product.
+    7. Return the singular values of Qx^T Qy (the canonical correlations).
+    End
+    ==========================================================================================================
+    """
+    # ----------------------------- Convert data to ndarray if it's not already ------------------------------
+    data = np.array(data) if not isinstance(data, np.ndarray) else data
+    data_ref = np.array(data_ref) if not isinstance(data_ref, np.ndarray) else data_ref
+
+    # Transpose the data if it has more than one dimension and has fewer rows than columns
+    data = data.T if data.ndim > 1 and data.shape[0] < data.shape[-1] else data
+    data = data[:, :, np.newaxis] if data.ndim == 2 else data          # A single trial
+    data_ref = data_ref[np.newaxis] if data_ref.ndim == 2 else data_ref  # A single stimulation frequency
+    data = data[:, num_channel, :] if num_channel is not None else data
+    # ------------------------------------------- Thin QR factors --------------------------------------------
+    x = np.transpose(data - np.mean(data, axis=0, dtype=dtype), (2, 0, 1)).astype(dtype, copy=False)
+    q_x = orthonormal_basis(x)                                          # (trials, samples, channels)
+    q_ref = reference_qr(data_ref, dtype) if q_ref is None else q_ref   # (frequencies, samples, references)
+    # ----------------------------------------- Correlation Analysis -----------------------------------------
+    num_trial, num_sample, num_x = q_x.shape
+    num_freq, _, num_y = q_ref.shape
+    # Qx^T Qy of all trials and frequencies as a single matrix product
+    qxy = np.swapaxes(q_x, 1, 2).reshape(-1, num_sample) @ np.moveaxis(q_ref, 1, 0).reshape(num_sample, -1)
+    qxy = qxy.reshape(num_trial, num_x, num_freq, num_y).transpose(0, 2, 1, 3)
+    cano_corr = np.linalg.svd(qxy, compute_uv=False)
+
+    return np.clip(cano_corr, 0, 1)
+
+
+# =================================================== CCA ====================================================
+def cca_analysis(data, data_ref, dtype=np.float64):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Canonical Correlation Analysis (CCA)
+    Parameters:
+    - data: EEG data or one set of variables with dimensions (number of samples, number of channels).
+    - data_ref: Reference data or another set of variables with dimensions (number of samples, number of
+    references).
+    - dtype: Floating point precision of the computation (np.float64 or np.float32).
+    ==================================== Flowchart for the cca function ======================================
+    Start
+    1. Convert data and data_ref to NumPy arrays if they are not already.
+    2. Transpose data and data_ref if they have more than one dimension and fewer rows than columns.
+    3. Remove the mean of data and data_ref and compute their thin QR factors Qx and Qy (Qy is cached).
+    4. Compute the singular values of Qx^T Qy.
+    5. Return the canonical correlations sorted in descending order.
+    End
+    ==========================================================================================================
+    """
+    # ----------------------------- Convert data to ndarray if it's not already ------------------------------
+    data = np.array(data) if not isinstance(data, np.ndarray) else data
+    data_ref = np.array(data_ref) if not isinstance(data_ref, np.ndarray) else data_ref
+
+    # Transpose the data if it has more than one dimension and has fewer rows than columns
+    data, data_ref = [x.T if x.ndim > 1 and x.shape[0] < x.shape[-1] else x for x in [data, data_ref]]
+    data, data_ref = [x[:, np.newaxis] if x.ndim == 1 else x for x in [data, data_ref]]
+
+    return cca_batch(data, data_ref, dtype=dtype)[0, 0]  # Return the canonical correlations
+
+
+# =========================================== Reference QR factors ===========================================
+def reference_qr(data_ref, dtype=np.float64):
+    """
+    Orthonormal basis (thin QR factor Q) of the centered reference signals, cached by content.
+    Parameters:
+    - data_ref: Reference signals with dimensions (number of frequencies, number of samples, number of
+    references) or (number of samples, number of references).
+    - dtype: Floating point precision of the basis (np.float64 or np.float32).
+    Output:
+    - q_ref: Read-only orthonormal basis with dimensions (number of frequencies, number of samples, number of
+    references).
+    """
+    data_ref = np.ascontiguousarray(data_ref, dtype=np.float64)
+    data_ref = data_ref[np.newaxis] if data_ref.ndim == 2 else data_ref
+
+    return _reference_qr(data_ref.tobytes(), data_ref.shape, np.dtype(dtype).str)
+
+
+@lru_cache(maxsize=64)
+def _reference_qr(buffer, shape, dtype):
+    data_ref = np.frombuffer(buffer).reshape(shape)
+    q_ref = orthonormal_basis(data_ref - np.mean(data_ref, axis=1, keepdims=True)).astype(dtype)
+    q_ref.flags.writeable = False  # The cached basis is shared by every caller
+
+    return q_ref
+
+
+# ============================================ Orthonormal basis =============================================
+def orthonormal_basis(x):
+    """
+    Orthonormal basis of the column space of a (stack of) matrices, truncated at the numerical rank.
+    Parameters:
+    - x: Matrices with dimensions (..., number of samples, number of columns).
+    Output:
+    - q: Basis with dimensions (..., number of samples, min(number of samples, number of columns)); the
+    columns beyond the rank of each matrix (same tolerance as np.linalg.matrix_rank) are zero, so they add
+    no canonical correlation instead of numerical noise.
+    """
+    q, r = np.linalg.qr(x)
+    u, s, _ = np.linalg.svd(r)                                   # Small (columns x columns) SVD of R
+    tol = s[..., :1] * max(x.shape[-2:]) * np.finfo(x.dtype).eps
+    u = u * (s > tol)[..., np.newaxis, :]                        # Drop the directions beyond the rank
+
+    return q @ u
+
+
+# ======================================== Inverse matrix square root ========================================
+def inv_sqrtm(cov):
+    """
+    Inverse square root of a (stack of) symmetric positive semi-definite matrices.
+    Parameters:
+    - cov: Covariance matrix with dimensions (..., n, n).
+    Output:
+    - w: Symmetric whitening matrix with dimensions (..., n, n) such that w @ cov @ w = I.
+    """
+    eig_vals, eig_vecs = np.linalg.eigh(cov)
+    # Floor tiny or negative eigenvalues, assuming they are due to numerical error (rank-deficient data)
+    floor = np.finfo(cov.dtype).eps * np.max(np.abs(eig_vals), axis=-1, keepdims=True)
+    eig_vals = np.maximum(eig_vals, floor + np.finfo(cov.dtype).tiny)
+
+    return (eig_vecs / np.sqrt(eig_vals)[..., np.newaxis, :]) @ np.swapaxes(eig_vecs, -1, -2)
@@ -1,4 +1,7 @@
 import os
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 # ============================================== Data path ===================================================
 # Function to construct the path to a data folder and list files within it
@@ -12,48 +15,144 @@ def data_path(folder_path, data_format, depth=0):
     - depth (optional): Current depth in the directory structure (default: 0).
     ================================= Flowchart for the data path function ===================================
     Start
-    1. Get the contents of the folder and sort them.
+    1. Get the contents of the folder with a single os.scandir call and sort them.
     2. Initialize lists to store files, folders, and files' paths.
     3. Iterate over each item in the folder:
-    a. Create the full path of the item.
-    b. If the item is a file:
+    a. If the item is a file:
         i. Append it to the files list along with its depth and full path.
-    c. If the item is a directory:
+        ii. If it ends with the specified data format, append its full path to the files_path list.
+    b. If the item is a directory:
         i. Append it to the folders list along with its depth and full path.
         ii. Recursively list files and folders in subfolders.
-        iii. Extend the files and folders lists with the subfiles and subfolders.
-    4. Iterate over the files:
-    a. Check if the file ends with the specified data format.
-    b. If it matches the data format, append its full path to the files_path list.
-    5. Return the list of files with the specified data format, all files, and all folders.
+        iii. Extend the files, files_path and folders lists with the subfiles and subfolders.
+    4. Return the list of files with the specified data format, all files, and all folders.
     End
     ==========================================================================================================
     """
-    contents = sorted(os.listdir(folder_path)) # Get the contents of the folder and sort them
+    with os.scandir(folder_path) as it:  # File type comes with the directory entry (no stat per item)
+        contents = sorted(it, key=lambda entry: entry.name)
     files = []             # Initialize lists to store files
     folders = []           # Initialize lists to store folders
     files_path = []        # Initialize lists to store files path
-    
+
     for item in contents:  # Iterate over each item in the folder
-        
-        item_path = os.path.join(folder_path, item) # Create the full path of the item
 
-        if os.path.isfile(item_path):               # Check if the item is a file
+        item_path = os.path.join(folder_path, item.name) # Create the full path of the item
+
+        if item.is_file():                          # Check if the item is a file
             # If it's a file, append it to the files list along with its depth and full path
-            files.append((item, depth, item_path))  
-        
-        elif os.path.isdir(item_path):              # Check if the item is a directory
+            files.append((item.name, depth, item_path))
+            if item_path.endswith(data_format):     # Keep the files with the specified data format
+                files_path.append(item_path)
+
+        elif item.is_dir():                         # Check if the item is a directory
             # If it's a directory, append it to the folders list along with its depth and full path
-            folders.append((item, depth, item_path))
+            folders.append((item.name, depth, item_path))
             # Recursively list files and folders in subfolders
-            _, sub_files, sub_folders= data_path(item_path, data_format, depth + 1)
+            sub_files_path, sub_files, sub_folders = data_path(item_path, data_format, depth + 1)
+            files_path.extend(sub_files_path)
             files.extend(sub_files)
             folders.extend(sub_folders)
-    # Iterate over the files and check if they end with the specified data format
-    for _, (_, _, val) in enumerate(files):
-        if val.endswith(data_format):
-            # If the file matches the data format, append its full path to the path_files list
-            files_path.append(val)
 
     # Return the list of files with specified data format, all files, and all folders
-    return files_path, files, folders
\ No newline at end of file
+    return files_path, files, folders
+
+
+# ============================================== Data manifest ===============================================
+def data_manifest(folder_path, data_format, manifest_path=None, metadata=False, n_jobs=1):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Example:
+    manifest = data_manifest(folder_path, "gdf", "manifest.json", metadata=True, n_jobs=8)
+    path_files = [val["path"] for val in manifest]
+
+    Index the files with the specified data format in a folder tree, with an on-disk manifest that is updated
+    incrementally.
+    Parameters:
+    - folder_path: Path to the folder to search.
+    - data_format: Desired format of the data files.
+    - manifest_path: JSON file of the manifest (default: None, no manifest is read or written).
+    - metadata: If True, also read the number of channels, the sampling frequency and the number of events
+    of each label from the file header (requires mne).
+    - n_jobs: Number of directories scanned (and headers read) in parallel (-1: all CPUs, default: 1).
+    Output:
+    - manifest: List of records sorted by path, one for each file: {"path", "size", "mtime"} and, if metadata
+    is True, {"num_channel", "fs", "events"}.
+    ============================== Flowchart for the data_manifest function ==================================
+    Start
+    1. Load the previous manifest from manifest_path (if it exists and was built for the same data format).
+    2. Walk the folder tree level by level, scanning the directories of each level in parallel:
+        a. If the mtime of a directory is unchanged, reuse its files and subdirectories from the manifest.
+        b. Otherwise, scan it with os.scandir, keeping only the files with the specified data format (pruned
+        during the walk) and their size and mtime.
+    3. If metadata is True, read the header of the new or modified files (size or mtime changed) in parallel.
+    4. Save the updated manifest to manifest_path.
+    5. Return the records sorted by path.
+    End
+    ==========================================================================================================
+    """
+    # ------------------------------------------ Previous manifest -------------------------------------------
+    previous = {"data_format": data_format, "directories": {}, "files": {}}
+    if manifest_path is not None and os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as file:
+            loaded = json.load(file)
+        previous = loaded if loaded.get("data_format") == data_format else previous
+    # ----------------------------------------------- Walk ---------------------------------------------------
+    directories, records = {}, {}
+    level = [folder_path]
+    n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 0 else max(1, int(n_jobs))
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        while level:   # Directories of the same level are scanned in parallel
+            scans = pool.map(lambda path: _scan_directory(path, data_format, previous["directories"].get(path)),
+                             level)
+            level = []
+            for path, scan in scans:
+                directories[path] = scan
+                level.extend(os.path.join(path, name) for name in scan["folders"])
+                for name, size, mtime in scan["files"]:
+                    record = {"path": os.path.join(path, name), "size": size, "mtime": mtime}
+                    old = previous["files"].get(record["path"], {})
+                    if old.get("size") == size and old.get("mtime") == mtime:
+                        record = {**old, **record}   # Unchanged file: keep its metadata
+                    records[record["path"]] = record
+        # -------------------------------------------- Metadata ----------------------------------------------
+        if metadata:
+            missing = [val for val in records.values() if "fs" not in val]
+            for record, header in zip(missing, pool.map(_read_header, [val["path"] for val in missing])):
+                record.update(header)
+    # ------------------------------------------- Save manifest ----------------------------------------------
+    if manifest_path is not None:
+        with open(manifest_path, "w") as file:
+            json.dump({"data_format": data_format, "directories": directories, "files": records}, file)
+
+    return [records[path] for path in sorted(records)]
+
+
+def _scan_directory(path, data_format, cached=None):
+    # Files with the data format (name, size, mtime) and subdirectories of a directory, reused from the
+    # manifest if the directory has not been modified
+    mtime = os.stat(path).st_mtime
+    if cached is not None and cached["mtime"] == mtime:
+        return path, cached
+
+    files, folders = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                folders.append(entry.name)
+            elif entry.name.endswith(data_format) and entry.is_file():   # Prune the other files
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime))
+
+    return path, {"mtime": mtime, "files": sorted(files), "folders": sorted(folders)}
+
+
+def _read_header(path):
+    import mne  # Optional dependency, only needed for the metadata
+
+    raw = mne.io.read_raw(path, preload=False, verbose=0)   # Header and annotations only
+    labels, counts = np.unique(np.asarray(raw.annotations.description, dtype=str), return_counts=True)
+
+    return {"num_channel": len(raw.ch_names), "fs": float(raw.info["sfreq"]),
+            "events": {str(lab): int(num) for lab, num in zip(labels, counts)}}
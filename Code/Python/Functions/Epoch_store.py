@@ -0,0 +1,230 @@
+import os
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .Epoching import epoch_starts
+
+# =============================================== Epoch store ================================================
+def save_epochs(store_path, data, labels, metadata=None, dtype=None):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Save epochs to an on-disk store: data.npy (trials, channels, samples), labels.npy and metadata.json.
+    Parameters:
+    - store_path: Folder of the store (created if it does not exist).
+    - data: EEG data matrix with dimensions (number of samples, number of channels, number of trials).
+    - labels: Label of each trial.
+    - metadata: Optional dictionary saved in metadata.json (e.g., fs, channels_name).
+    - dtype: Data type of the store (default: dtype of data).
+    Output:
+    - data: Memory-mapped data with dimensions (number of samples, number of channels, number of trials), as
+    returned by load_epochs.
+    ==========================================================================================================
+    """
+    data = np.asarray(data)
+    epochs = create_epochs(store_path, (data.shape[-1], data.shape[1], data.shape[0]), dtype or data.dtype)
+    epochs[...] = data.T                                       # (trials, channels, samples)
+    epochs.flush()
+    del epochs
+    write_sidecars(store_path, labels, metadata)
+
+    return load_epochs(store_path)[0]
+
+
+def load_epochs(store_path, mmap_mode="r"):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Example:
+    data, labels, metadata = load_epochs(store_path)
+    predict_label = CCA.cca(data, metadata["fs"], f_stim, num_channel, num_harmonic)
+
+    Open an epoch store without reading the data (zero-copy memory map).
+    Parameters:
+    - store_path: Folder of the store.
+    - mmap_mode: Memory-map mode of data.npy ('r': read-only, 'r+': read/write, 'c': copy-on-write).
+    Outputs:
+    - data: View with dimensions (number of samples, number of channels, number of trials) of the
+    memory-mapped (trials, channels, samples) array; it can be passed directly to Filtering, CCA, PSDA, etc.
+    - labels: Label of each trial.
+    - metadata: Dictionary from metadata.json.
+    ==========================================================================================================
+    """
+    epochs = np.load(os.path.join(store_path, "data.npy"), mmap_mode=mmap_mode)
+    labels = np.load(os.path.join(store_path, "labels.npy"))
+    with open(os.path.join(store_path, "metadata.json"), "r") as file:
+        metadata = json.load(file)
+
+    return epochs.T, labels, metadata
+
+
+def create_epochs(store_path, shape, dtype=np.float32):
+    """
+    Create (or overwrite) data.npy of a store as a writable memory map with dimensions shape = (number of
+    trials, number of channels, number of samples).
+    """
+    os.makedirs(store_path, exist_ok=True)
+    shape = tuple(int(val) for val in shape)
+
+    return np.lib.format.open_memmap(os.path.join(store_path, "data.npy"), mode="w+", dtype=dtype, shape=shape)
+
+
+def write_sidecars(store_path, labels, metadata=None):
+    """
+    Write labels.npy and metadata.json of a store.
+    """
+    np.save(os.path.join(store_path, "labels.npy"), np.asarray(labels))
+    with open(os.path.join(store_path, "metadata.json"), "w") as file:
+        json.dump(metadata or {}, file, indent=2)
+
+
+# ============================================== Load sessions ===============================================
+def load_sessions(path_files, lab, time_trial, dtype=np.float32, scale=1e6, n_jobs=4, max_in_flight=None,
+                  store_path=None):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Example:
+    path_files, _, _ = Data_path.data_path(folder_path, data_format="gdf")
+    data, labels, metadata = load_sessions(path_files, ['33025', '33026', '33027'], 5, n_jobs=8)
+
+    Load the trials of many recordings (e.g., GDF sessions) into a single preallocated trial tensor, reading
+    the files with a pool of workers and decoding only the samples of each trial.
+    Parameters:
+    - path_files: List of the recording files (read with mne), e.g., from Data_path.data_path.
+    - lab: Annotation descriptions of the labels of interest (label i of the output is lab[i]).
+    - time_trial: Duration of each trial in seconds.
+    - dtype: Data type of the trial tensor (default: np.float32).
+    - scale: Scale factor of the data (default: 1e6, from V to uV).
+    - n_jobs: Number of files read in parallel (-1: all CPUs, default: 4).
+    - max_in_flight: Maximum number of sessions being decoded at the same time (default: n_jobs).
+    - store_path: If given, the trial tensor is the data.npy memory map of an epoch store (see create_epochs)
+    instead of an array in memory.
+    Outputs:
+    - data: Trials with dimensions (number of samples, number of channels, number of trials), grouped by
+    label, and by file and time within each label.
+    - labels: Index in lab of the label of each trial.
+    - metadata: Dictionary with fs, channels_name, lab, time_trial, files, and the source file and onset
+    (sample) of each trial.
+    ================================ Flowchart for the load_sessions function ================================
+    Start
+    1. Read the header and events (mne.events_from_annotations) of every file in parallel (no data) and get
+    the start sample and label of the complete trials (Epoching.epoch_starts).
+    2. Check that all the files have the same sampling frequency and number of channels.
+    3. Preallocate the trial tensor with the total number of trials, and give each trial its row (trials
+    grouped by label, then by file).
+    4. Submit the files to the pool, keeping at most max_in_flight of them in flight; each worker decodes only
+    the window of every trial (raw.get_data(start, stop)) and writes it, scaled and cast to dtype, into its
+    row of the tensor.
+    5. Return the trial tensor, the labels and the metadata.
+    End
+    ==========================================================================================================
+    """
+    n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 0 else max(1, int(n_jobs))
+    max_in_flight = max(1, int(max_in_flight or n_jobs))
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        # ------------------------------------- Headers and trial counts -------------------------------------
+        sessions = list(pool.map(lambda path: _read_session(path, lab, time_trial), path_files))
+        fs, channels_name, duration_trial = sessions[0][:3]
+        if any(val[0] != fs or len(val[1]) != len(channels_name) for val in sessions):
+            raise ValueError("All the recordings must have the same sampling frequency and number of "
+                             "channels")
+        # Number of trials of each file and label: (files, labels)
+        num_trials = np.array([np.bincount(val[4], minlength=len(lab)) for val in sessions])
+        # ------------------------------------------- Trial tensor -------------------------------------------
+        shape = (num_trials.sum(), len(channels_name), duration_trial)
+        data = create_epochs(store_path, shape, dtype).T if store_path else np.empty(shape[::-1], dtype=dtype)
+        # First row of every (file, label) block: trials grouped by label, then by file
+        block = np.cumsum(num_trials.T.ravel()) - num_trials.T.ravel()
+        block = block.reshape(len(lab), len(sessions)).T
+        source, onsets = np.zeros(shape[0], dtype=int), np.zeros(shape[0], dtype=int)
+        # ---------------------------------------- Bounded streaming -----------------------------------------
+        pending = set()
+        for ind, (_, _, _, start, labels) in enumerate(sessions):
+            rows = np.zeros(len(start), dtype=int)
+            for j in range(len(lab)):      # Row of each trial of the file, in time order within each label
+                rows[labels == j] = block[ind, j] + np.arange(num_trials[ind, j])
+            source[rows], onsets[rows] = ind, start
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()        # Raise the errors of the workers
+            pending.add(pool.submit(_read_windows, path_files[ind], start, rows, duration_trial, data, scale))
+        for future in pending:
+            future.result()
+
+    labels = np.repeat(np.arange(len(lab)), num_trials.sum(axis=0))
+    metadata = {"fs": fs, "channels_name": list(channels_name), "lab": list(lab), "time_trial": time_trial,
+                "files": list(path_files), "source": source.tolist(), "onset": onsets.tolist()}
+
+    return data, labels, metadata
+
+
+def _read_session(path, lab, time_trial):
+    # Header and trials of interest of a recording (no data): fs, channels, samples per trial, start, labels
+    import mne  # Optional dependency, only needed to read the recordings
+
+    raw = mne.io.read_raw(path, preload=False, verbose=0)
+    fs = raw.info["sfreq"]
+    duration_trial = int(fs * time_trial)
+    # Events as in the notebooks (rounded onsets, orig_time and first_samp handled by mne), with the sample
+    # relative to the first sample of the data and the description of each event from its code
+    events, event_id = mne.events_from_annotations(raw, verbose=0)
+    onset = events[:, 0] - raw.first_samp
+    code_description = {code: description for description, code in event_id.items()}
+    description = np.array([code_description[code] for code in events[:, 2]], dtype=str)
+    # Trials of each label that fit in the recording
+    start, labels, _ = epoch_starts(onset, raw.n_times, duration_trial, description, lab)
+
+    return fs, raw.ch_names, duration_trial, start, labels
+
+
+def _read_windows(path, start, rows, duration_trial, out, scale):
+    # Worker: decode only the window of each trial and write it into its row of out (disjoint rows)
+    import mne
+
+    raw = mne.io.read_raw(path, preload=False, verbose=0)
+    for row, val in zip(rows, start):
+        out[..., row] = scale * raw.get_data(start=val, stop=val + duration_trial).T
+
+
+# ============================================ Convert sessions ==============================================
+def convert_sessions(path_files, store_path, lab, time_trial, dtype=np.float32, scale=1e6, n_jobs=4,
+                     max_in_flight=None):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Example:
+    path_files, _, _ = Data_path.data_path(folder_path, data_format="gdf")
+    data, labels, metadata = convert_sessions(path_files, store_path, ['33025', '33026', '33027'], 5)
+
+    Convert the recordings (e.g., GDF sessions) once into a memory-mapped epoch store.
+    Parameters:
+    - path_files: List of the recording files (read with mne).
+    - store_path: Folder of the store.
+    - lab: Annotation descriptions of the labels of interest (label i of the store is lab[i]).
+    - time_trial: Duration of each trial in seconds.
+    - dtype: Data type of the store (default: np.float32).
+    - scale: Scale factor of the data (default: 1e6, from V to uV).
+    - n_jobs, max_in_flight: Number of files read in parallel and maximum number of sessions being decoded
+    at the same time (see load_sessions).
+    Outputs:
+    - data, labels, metadata: The store, as returned by load_epochs. The trials are grouped by label, and by
+    file and time within each label.
+    =============================== Flowchart for the convert_sessions function ==============================
+    Start
+    1. Load the trials of all the files directly into the memory-mapped store (trials, channels, samples) with
+    load_sessions.
+    2. Write the labels and the metadata (fs, channels, files, source file and onset of each trial).
+    3. Return the store opened read-only.
+    End
+    ==========================================================================================================
+    """
+    data, labels, metadata = load_sessions(path_files, lab, time_trial, dtype, scale, n_jobs, max_in_flight,
+                                           store_path=store_path)
+    data.flush()
+    del data
+    write_sidecars(store_path, labels, metadata)
+
+    return load_epochs(store_path)
@@ -0,0 +1,85 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided, sliding_window_view
+
+# ================================================ Epoching ==================================================
+def extract_epochs(data, events, duration_trial, description=None, lab=None, offset=0, latency=0,
+                   group_by_label=False, copy=True):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Example:
+    events, _ = mne.events_from_annotations(raw, verbose=0)
+    data_trials = extract_epochs(data, events[:, 0], duration_trial, labels, lab, group_by_label=True)
+
+    EXTRACT_EPOCHS cuts the trials of a continuous recording in a single gather.
+    Inputs:
+    - data: Continuous EEG data with dimensions (number of samples, number of channels).
+    - events: Onset sample of each event, or an events array (number of events, 3) with the onsets in the first
+    column and the event codes in the last column (e.g., from mne.events_from_annotations).
+    - duration_trial: Number of samples of each trial (after the onset).
+    - description: Label of each event, e.g., raw.annotations.description (default: event codes of events).
+    - lab: Labels of interest; label i of the output is lab[i] (default: all the labels, sorted).
+    - offset: Number of samples kept before the onset (baseline), added to the length of the trials.
+    - latency: Shift of the onsets in samples (e.g., the visual latency of the stimulation).
+    - group_by_label: If True, return one array of trials for each label of lab.
+    - copy: If False and the trials start at evenly spaced samples, return a read-only strided view of data
+    without copying (otherwise a single gather).
+    Outputs:
+    - epochs: Trials with dimensions (offset + duration_trial, number of channels, number of trials), or a
+    list with one such array for each label if group_by_label is True.
+    - labels: Index in lab of the label of each trial (only if group_by_label is False).
+    ================================ Flowchart for the extract_epochs function ===============================
+    Start
+    1. Get the start sample (onset + latency - offset) and the label of each trial of interest, dropping the
+    trials that do not fit in the recording (epoch_starts).
+    2. Build the windows of data as a strided view (sliding_window_view, no copy).
+    3. If copy is False and the starts are evenly spaced, return a strided view of the trials.
+    4. Otherwise, gather all the trials with a single fancy-indexing operation.
+    5. If group_by_label is True, gather the trials sorted by label and split them into one view per label.
+    6. Return the trials with the samples along the first axis and the trials along the last axis.
+    End
+    ==========================================================================================================
+    """
+    # ----------------------------- Convert data to ndarray if it's not already ------------------------------
+    data = np.asarray(data)
+    data = data[:, np.newaxis] if data.ndim == 1 else data
+    num_window = offset + duration_trial
+    start, labels, lab = epoch_starts(events, data.shape[0], duration_trial, description, lab, offset, latency)
+    # ----------------------------------------------- Trials -------------------------------------------------
+    step = np.diff(start)
+    if not copy and len(start) > 1 and step[0] > 0 and np.all(step == step[0]) and not group_by_label:
+        # Evenly spaced trials: (samples, channels, trials) view of data
+        view = data[start[0]:]
+        epochs = as_strided(view, shape=(num_window, data.shape[1], len(start)), writeable=False,
+                            strides=(view.strides[0], view.strides[1], step[0] * view.strides[0]))
+        return epochs, labels
+
+    windows = sliding_window_view(data, num_window, axis=0)   # (samples, channels, window), no copy
+    if group_by_label:   # Gather the trials sorted by label and split them (views)
+        order = np.argsort(labels, kind="stable")
+        epochs = windows[start[order]].T
+        return np.split(epochs, np.cumsum(np.bincount(labels, minlength=len(lab)))[:-1], axis=-1)
+
+    return windows[start].T, labels                           # Single gather: (window, channels, trials)
+
+
+def epoch_starts(events, num_sample, duration_trial, description=None, lab=None, offset=0, latency=0):
+    """
+    Start sample and label index of the trials of interest that fit in a recording of num_sample samples
+    (see extract_epochs for the inputs).
+    Outputs:
+    - start: Start sample (onset + latency - offset) of each trial.
+    - labels: Index in lab of the label of each trial.
+    - lab: Labels of interest (the sorted labels of the events if lab is None).
+    """
+    events = np.asarray(events)
+    onset = events[:, 0] if events.ndim > 1 else events
+    description = np.asarray(description if description is not None else events[:, -1])
+    lab = np.unique(description) if lab is None else np.asarray(lab)
+    # Label index of each event (-1 for the events that are not of interest)
+    match = description[:, np.newaxis] == lab[np.newaxis, :]
+    labels = np.where(np.any(match, axis=1), np.argmax(match, axis=1), -1)
+    start = np.asarray(onset, dtype=int) + latency - offset
+    keep = (labels >= 0) & (start >= 0) & (start + offset + duration_trial <= num_sample)
+
+    return start[keep], labels[keep], lab
@@ -1,7 +1,9 @@
 import numpy as np
+from scipy import fft
+from functools import lru_cache
 
 # ========================================== FFT_Feature_Extraction ==========================================
-def fft_feature_extraction(data, fs, num_channel, subbands):
+def fft_feature_extraction(data, fs, num_channel, subbands, dtype=np.float64, out=None):
     """
     =============================== Presented by: Reza Saadatyar (2023-2024) =================================
     ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
@@ -10,43 +12,65 @@ def fft_feature_extraction(data, fs, num_channel, subbands):
     - fs: Sampling frequency.
     - num_channel: List or array of channel indices to consider for feature extraction.
     - subbands: List or array of tuples specifying the frequency subbands.
+    - dtype: Data type of the computation and of the features (e.g., np.float32, default: np.float64).
+    - out: Optional array (number of trials, number of subbands * number of channels) filled with the
+    features, e.g., reused across cross-validation folds.
     ========================== Flowchart for the fft_feature_extraction function =============================
     Start
     1. Convert data to a numpy array if it's not already in that format.
     2. Transpose the data if necessary to ensure proper dimensions.
-    3. Calculate the frequency vector f using the sampling frequency fs.
-    4. Initialize an array `features` to store the extracted features, with dimensions (number of trials, 
-    number of subbands * number of channels).
-    5. Loop over each trial in the data:
-        a. Compute the FFT (Fast Fourier Transform) of the EEG data for the selected channels.
-        b. Compute the power spectral density (PSD) by taking the absolute value of the FFT and selecting 
-        only the positive frequency components.
-        c. Loop over each subband:
-            i. Find the indices corresponding to the frequency subband.
-            ii. Extract the maximum PSD within the subband for each channel and update the `features` array.
-    6. Return the `features` array.
+    3. Get the bin range [start, stop) of each subband from the cache (computed once per fs, number of samples
+    and subbands on the frequency vector f).
+    4. Compute the amplitude spectrum of the selected channels of all trials with a single rfft along the time
+    axis (the last bin, fs / 2, is excluded as in the one-sided fft).
+    5. Take the maximum of the amplitude spectrum within every subband, reduced straight into a (subbands,
+    channels, trials) view of out (allocated if not given), so no temporary of the features is created.
+    6. Return the features array `out` with dimensions (number of trials, number of subbands * number of
+    channels), ordered by subband and then by channel.
     End
     ==========================================================================================================
     """
     # --------------------------- Convert data to ndarray if it's not already --------------------------------
     data = np.array(data) if not isinstance(data, np.ndarray) else data
-    
+
     # Transpose the data if it has more than one dimension and has fewer rows than columns
     data = data.T if data.ndim > 1 and data.shape[0] < data.shape[-1] else data
-    
-    f = np.linspace(0, fs / 2, data.shape[0] // 2 + 1) # Calculate frequency vector
-    features = np.zeros((data.shape[-1], np.array(subbands).shape[1] * len(num_channel)))
-
-    for i in range(data.shape[-1]):
-        data_fft = np.fft.fft(data[:, num_channel, i], axis=0) # Compute FFT
-        data_psd = np.abs(data_fft[:len(data_fft) // 2, :])    # Compute power spectral density (PSD)
-        
-        for ind_sb, (val_sb1, val_sb2) in enumerate(zip(*subbands)): # Feature extraction for each subband
-            # Find indices corresponding to the subband
-            ind = np.where((f >= val_sb1) & (f <= val_sb2))[0]
-            
-            # Update features with maximum PSD within subband
-            features[i, ind_sb * len(num_channel):(ind_sb + 1) * len(num_channel)] = np.max(data_psd[ind, :],
-                                                                                        axis=0)
-
-    return features
\ No newline at end of file
+    data = data[:, :, np.newaxis] if data.ndim == 2 else data   # A single trial
+
+    bounds = subband_bins(fs, data.shape[0], subbands)          # [start, stop) of each subband
+    # Amplitude spectrum of all trials: (data.shape[0] // 2 + 1, channels, trials)
+    data_psd = np.abs(fft.rfft(data[:, num_channel, :].astype(dtype, copy=False), axis=0))
+    out = np.empty((data.shape[-1], len(bounds) * data_psd.shape[1]), dtype) if out is None else out
+    if not out.flags.c_contiguous:   # The reshape below must be a view of out
+        raise ValueError("out must be a C-contiguous array (number of trials, subbands * channels)")
+    features = out.reshape(data.shape[-1], len(bounds), -1).transpose(1, 2, 0)   # (subbands, channels, trial)
+    # Maximum within each subband, reduced straight into the view of out
+    for ind, (start, stop) in enumerate(bounds):
+        np.max(data_psd[start:stop], axis=0, out=features[ind])
+
+    return out
+
+
+# ============================================== Subband bins ================================================
+def subband_bins(fs, num_sample, subbands):
+    """
+    Bin range [start, stop) of each subband on the frequency vector np.linspace(0, fs / 2, num_sample // 2
+    + 1) of the one-sided spectrum (without its last bin), cached by the parameters.
+    Output:
+    - bounds: Array with dimensions (number of subbands, 2), read-only.
+    """
+    low, high = np.array(subbands, dtype=float)   # Lower and upper edges of the subbands
+
+    return _subband_bins(float(fs), int(num_sample), tuple(low), tuple(high))
+
+
+@lru_cache(maxsize=64)
+def _subband_bins(fs, num_sample, low, high):
+    f = np.linspace(0, fs / 2, num_sample // 2 + 1)[:num_sample // 2]   # Calculate frequency vector
+    # The subbands are contiguous because f is sorted: [start, stop) matches f >= low & f <= high
+    bounds = np.stack((np.searchsorted(f, low, side="left"), np.searchsorted(f, high, side="right")), axis=1)
+    if np.any(bounds[:, 1] <= bounds[:, 0]):
+        raise ValueError("No frequency bin in a subband (check fs, the number of samples and the subbands)")
+    bounds.flags.writeable = False  # The cached table is shared by every caller
+
+    return bounds
@@ -1,11 +1,14 @@
+import os
+import time
 import numpy as np
-from scipy.stats import f_oneway
+from scipy import stats
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from skfeature.function.similarity_based import fisher_score
-from sklearn import feature_selection, preprocessing, linear_model, ensemble, svm
+from sklearn import base, feature_selection, preprocessing, linear_model, ensemble, svm, model_selection
 
 # ============================================= Feature selection ============================================
 def feature_selecions(data, labels, num_features, threshold_var=0.1, n_neighbors_MI=2, L1_Parameter= 0.2,
-                     type_feature_selection="var"):
+                     type_feature_selection="var", n_jobs=1):
   """
   ================================ Presented by: Reza Saadatyar (2023-2024) ==================================
   ================================= E-mail: Reza.Saadatyar@outlook.com =======================================
@@ -29,7 +32,8 @@ def feature_selecions(data, labels, num_features, threshold_var=0.1, n_neighbors
       - "rf": Random forest feature selection.
       - "l1fs": L1-based feature selection.
       - "tfs": Tree-based feature selection.
-      
+  - n_jobs: Number of parallel workers over the candidate features of "ffs" and "bfs" (-1: all CPUs).
+
   Outputs:
   - features: The selected features.
   ============================== Flowchart for the Feature selection function ================================
@@ -37,17 +41,19 @@ def feature_selecions(data, labels, num_features, threshold_var=0.1, n_neighbors
   2. Convert the input data to a NumPy array if it's not already.
   3. Transpose the data if it has more than one dimension and fewer rows than columns.
   4. Set the number of features to the total number of features if it exceeds.
-  5. Implement feature selection based on the specified method:
+  5. Implement feature selection based on the specified method (scores computed once by FeatureSelector):
     a. Filter Methods:
         i. Variance thresholding: Filter features based on variance.
-        ii. ANOVA: Compute p-values for each feature using ANOVA and select top features.
+        ii. ANOVA: Compute the F statistic of all features at once (anova_f) and select top features.
         iii. Mutual Information: Select features based on mutual information with class labels.
         iv. Univariate Feature Selection: Select top k features using chi-squared test.
         v. Fisher Score: Select top features based on Fisher score.
     b. Wrapper Methods:
         i. Recursive Feature Elimination (RFE): Select features recursively using logistic regression.
-        ii. Forward Feature Selection (FFS): Select features forwardly based on logistic regression.
-        iii. Backward Feature Selection (BFS): Select features backwardly based on logistic regression.
+        ii. Forward Feature Selection (FFS): Select features forwardly based on logistic regression
+        (sequential_selection).
+        iii. Backward Feature Selection (BFS): Select features backwardly based on logistic regression
+        (sequential_selection).
         iv. Random Forest: Select top features based on random forest feature importances.
         v. L1-based Feature Selection: Select features based on linear SVM with L1 regularization.
         vi. Tree-based Feature Selection: Select top features based on extra trees classifier.
@@ -59,59 +65,292 @@ def feature_selecions(data, labels, num_features, threshold_var=0.1, n_neighbors
   data = np.array(data) if not isinstance(data, np.ndarray) else data
   # -------- Transpose the data if it has more than one dimension and has fewer rows than columns ----------
   data = data.T if data.ndim > 1 and data.shape[0] < data.shape[-1] else data
-  #  ------------------- Set num_features to total number of features if it exceeds ------------------------
-  num_features = data.shape[1] if num_features > data.shape[1] else num_features
-  # -------------------------------------- Filter Methods --------------------------------------------------
-  if type_feature_selection.lower() == "var":             # Variance
-    mod = feature_selection.VarianceThreshold(threshold=threshold_var)
-    mod.fit(data)
-    features = mod.transform(data)
-  elif type_feature_selection.lower() == "anova":
-    pvalue = np.zeros(data.shape[1])
-    for i in range(data.shape[1]):                        # Compute p-values for each feature using ANOVA
-        pvalue[i] = f_oneway(data[:, i], labels)[1]
-    ind = np.argsort(pvalue)                              # Sort p-values and get indices of sorted features 
-    features = data[:, ind[:num_features]]                # Select top num_features features
-  elif type_feature_selection.lower() == "mi":            # Mutual information
-    mod = feature_selection.mutual_info_classif(data, labels, n_neighbors=n_neighbors_MI)
-    features = data[:, np.argsort(mod)[-num_features:]]
-  elif type_feature_selection.lower() == "ufs":           # Univariate feature selection
-    scaler = preprocessing.MinMaxScaler()                 # Perform Min-Max scaling
-    data = scaler.fit_transform(data)
-    mod = feature_selection.SelectKBest(feature_selection.chi2, k=num_features)
-    features = mod.fit_transform(data, labels)
-  elif type_feature_selection.lower() == 'fs':            # Fisher_score
-      mod = fisher_score.fisher_score(data, labels)
-      features = data[:, mod[-num_features:]]
-  # --------------------------------------- Wrapper Methods -------------------------------------------------
-  elif type_feature_selection.lower() ==  "rfe":          # Recursive feature elimination
-    mod = feature_selection.RFE(estimator=linear_model.LogisticRegression(max_iter=1000), n_features_to_select=
-                                num_features)
-    mod.fit(data, labels)
-    features = mod.transform(data)
-  elif type_feature_selection.lower() == 'ffs':           # Forward feature selection
-      mod = linear_model.LogisticRegression(max_iter=1000)
-      mod = feature_selection.SequentialFeatureSelector(mod, n_features_to_select=num_features, direction=
-                                                        "forward", cv=5, scoring='accuracy')
-      mod.fit(data, labels)
-      features = data[:, mod.support_]                    # Optimal number of feature
-  elif type_feature_selection.lower() == 'bfs':           # Backward feature selection
-      mod = linear_model.LogisticRegression(max_iter=1000)
-      mod = feature_selection.SequentialFeatureSelector(mod, n_features_to_select=num_features, direction=
-                                                        "backward", cv=5, scoring='accuracy')
-      mod.fit(data, labels)
-      features = data[:, mod.support_]                    # Optimal number of feature
-  elif type_feature_selection.lower() == "rf":            # Random forest
-    mod = ensemble.RandomForestClassifier(n_estimators=10, random_state=0)
-    mod.fit(data, labels)
-    features = data[:, np.argsort(mod.feature_importances_)[-num_features:]]
-  elif type_feature_selection.lower() ==  "l1fs":         # L1-based feature selection;The smaller C the fewer feature selected
-    mod = svm.LinearSVC(C=L1_Parameter, penalty='l1', dual=False, max_iter=1000).fit(data, labels)
-    mod = feature_selection.SelectFromModel(mod, prefit=True)
-    features = mod.transform(data)
-  elif type_feature_selection.lower() == "tfs":           # Tree-based feature selection
-    mod = ensemble.ExtraTreesClassifier(n_estimators=100)
-    mod.fit(data, labels)
-    features = data[:, np.argsort(mod.feature_importances_)[-num_features:]]
-
-  return features
\ No newline at end of file
+  # ------------------------- Fit the selector once and keep the selected features -------------------------
+  mod = FeatureSelector(type_feature_selection, num_features, threshold_var, n_neighbors_MI, L1_Parameter,
+                        n_jobs)
+
+  return mod.fit_transform(data, labels)
+
+
+# ============================================= Feature selector =============================================
+class FeatureSelector:
+  """
+  ================================ Presented by: Reza Saadatyar (2023-2024) ==================================
+  ================================= E-mail: Reza.Saadatyar@outlook.com =======================================
+  Feature selector that scores (or ranks) the features once and selects the top-k features for any k, with
+  the same mask for the training and held-out data.
+  Inputs:
+  - type_feature_selection: The type of feature selection method (see feature_selecions).
+  - num_features: The default number of features to select (default: all the features).
+  - threshold_var: The variance threshold for variance-based feature selection.
+  - n_neighbors_MI: The number of neighbors for mutual information-based feature selection.
+  - L1_Parameter: The parameter for L1-based feature selection.
+  - n_jobs: Number of parallel workers over the candidate features of "ffs" and "bfs" (-1: all CPUs).
+  - tol: Early stopping of "ffs" and "bfs" when the CV accuracy plateaus (see sequential_selection).
+  Attributes (after fit):
+  - scores_: Score of each feature, higher is better (None for "ffs" and "bfs").
+  - ranking_: Indices of the features sorted from the best to the worst (the selected ones for "ffs"/"bfs").
+  - support_: Boolean mask of the selected features (top num_features, or the threshold of "var"/"l1fs").
+  - history_: CV accuracy and time of each step of the last "ffs"/"bfs" search (see sequential_selection).
+  Usage:
+  - mod = FeatureSelector("mi").fit(data_train, labels_train)  # data: (number of samples, number of features)
+  - for k in range(1, 201): data_k, test_k = mod.transform(data_train, k), mod.transform(data_test, k)
+  ============================== Flowchart for the FeatureSelector class =====================================
+  1. Start
+  2. fit: Compute the scores (filter and embedded methods) or the ranking (RFE, Fisher score) of all the
+  features once, and sort the features from the best to the worst (ranking_).
+  3. indices(k): Return the top-k features of ranking_ without recomputation ("var" and "l1fs" select by
+  threshold if k is None). For "ffs"/"bfs" every subset visited by the sequential search is cached, and a
+  new search is run only for a k it did not visit.
+  4. transform(data, k): Select the columns indices(k) of the training or held-out data.
+  5. End.
+  ============================================================================================================
+  """
+  def __init__(self, type_feature_selection="var", num_features=None, threshold_var=0.1, n_neighbors_MI=2,
+               L1_Parameter=0.2, n_jobs=1, tol=None):
+    self.type_feature_selection = type_feature_selection.lower()
+    self.num_features = num_features
+    self.threshold_var = threshold_var
+    self.n_neighbors_MI = n_neighbors_MI
+    self.L1_Parameter = L1_Parameter
+    self.n_jobs = n_jobs
+    self.tol = tol
+
+  def fit(self, data, labels):
+    data = np.array(data) if not isinstance(data, np.ndarray) else data
+    method, num_features = self.type_feature_selection, self._num_features(None, data.shape[1])
+    self.scores_, self._threshold, self._subsets = None, None, {}
+    # -------------------------------------- Filter Methods ------------------------------------------------
+    if method == "var":                                   # Variance
+      self.scores_ = np.var(data, axis=0)
+      self._threshold = self.scores_ > self.threshold_var
+    elif method == "anova":                               # F statistic (p-values underflow to 0 and tie)
+      self.scores_ = np.nan_to_num(anova_f(data, labels)[0], nan=-np.inf)   # Constant features rank last
+    elif method == "mi":                                  # Mutual information
+      self.scores_ = feature_selection.mutual_info_classif(data, labels, n_neighbors=self.n_neighbors_MI)
+    elif method == "ufs":                                 # Univariate feature selection (chi-squared)
+      self.scores_ = feature_selection.chi2(preprocessing.MinMaxScaler().fit_transform(data), labels)[0]
+    elif method == "fs":                                  # Fisher score: features ordered from the worst
+      order = np.asarray(fisher_score.fisher_score(data, labels))
+      self.scores_ = np.argsort(order).astype(float)      # Position of each feature in the order
+    # --------------------------------------- Wrapper Methods ----------------------------------------------
+    elif method == "rfe":                                 # Recursive feature elimination down to 1 feature
+      mod = feature_selection.RFE(estimator=linear_model.LogisticRegression(max_iter=1000),
+                                  n_features_to_select=1).fit(data, labels)
+      self.scores_ = -mod.ranking_.astype(float)          # Features eliminated last rank first
+    elif method in ("ffs", "bfs"):                        # Sequential selection, depends on the number k
+      self._data, self._labels = data, labels
+    elif method == "rf":                                  # Random forest
+      mod = ensemble.RandomForestClassifier(n_estimators=10, random_state=0).fit(data, labels)
+      self.scores_ = mod.feature_importances_
+    elif method == "l1fs":                                # L1-based; the smaller C the fewer feature selected
+      mod = svm.LinearSVC(C=self.L1_Parameter, penalty='l1', dual=False, max_iter=1000).fit(data, labels)
+      self.scores_ = np.sum(np.abs(np.atleast_2d(mod.coef_)), axis=0)
+      self._threshold = feature_selection.SelectFromModel(mod, prefit=True).get_support()
+    elif method == "tfs":                                 # Tree-based feature selection
+      mod = ensemble.ExtraTreesClassifier(n_estimators=100).fit(data, labels)
+      self.scores_ = mod.feature_importances_
+    else:
+      raise ValueError(f"Unknown feature selection method '{self.type_feature_selection}'")
+
+    self.num_features_in_ = data.shape[1]
+    self.ranking_ = (self._sequential(num_features) if self.scores_ is None else
+                     np.argsort(-self.scores_, kind="stable"))   # Best first, ties in column order
+    self.support_ = self.get_support()
+
+    return self
+
+  def indices(self, num_features=None):
+    """Indices of the top num_features features, best first (default: num_features of the selector)."""
+    if num_features is None and self._threshold is not None:
+      return np.flatnonzero(self._threshold)               # Threshold selection of "var" and "l1fs"
+    num_features = self._num_features(num_features, self.num_features_in_)
+    if self.scores_ is None:
+      return self._sequential(num_features)
+
+    return self.ranking_[:num_features]
+
+  def get_support(self, num_features=None):
+    """Boolean mask of the top num_features features."""
+    support = np.zeros(self.num_features_in_, dtype=bool)
+    support[self.indices(num_features)] = True
+
+    return support
+
+  def transform(self, data, num_features=None):
+    """Select the top num_features features of data (number of samples, number of features)."""
+    data = np.array(data) if not isinstance(data, np.ndarray) else data
+
+    return data[:, self.indices(num_features)]
+
+  def fit_transform(self, data, labels, num_features=None):
+    return self.fit(data, labels).transform(data, num_features)
+
+  def _num_features(self, num_features, total):
+    # Set num_features to total number of features if it exceeds (or is not given)
+    num_features = self.num_features if num_features is None else num_features
+
+    return total if num_features is None or num_features > total else int(num_features)
+
+  def _sequential(self, num_features):
+    # Forward/backward feature selection of num_features features; the subsets of every step are cached
+    if num_features not in self._subsets:
+      direction = "forward" if self.type_feature_selection == "ffs" else "backward"
+      selected, self.history_ = sequential_selection(self._data, self._labels, num_features, direction,
+                                                     n_jobs=self.n_jobs, tol=self.tol)
+      step = self.history_["features"]
+      for i in range(len(step)):   # Subset after each step: nested for forward and backward selection
+        subset = step[:i + 1] if direction == "forward" else np.setdiff1d(np.arange(self._data.shape[1]),
+                                                                          step[:i + 1])
+        self._subsets.setdefault(len(subset), np.asarray(subset))
+      self._subsets[num_features] = selected                # Optimal number of feature
+
+    return self._subsets[num_features]
+
+
+# ===================================== Sequential feature selection =========================================
+def sequential_selection(data, labels, num_features, direction="forward", cv=5, estimator=None, n_jobs=1,
+                         backend="process", tol=None, patience=1, verbose=False):
+  """
+  ================================ Presented by: Reza Saadatyar (2023-2024) ==================================
+  ================================= E-mail: Reza.Saadatyar@outlook.com =======================================
+  Example:
+  selected, history = sequential_selection(features, labels, 20, "forward", n_jobs=-1, tol=1e-3)
+
+  Forward or backward sequential feature selection with the candidate features of each step evaluated in
+  parallel, on fixed cross-validation folds standardized once.
+  Inputs:
+  - data: The feature matrix with dimensions (number of samples, number of features).
+  - labels: The labels corresponding to each sample.
+  - num_features: The number of features to select.
+  - direction: "forward" (add the best feature at each step) or "backward" (remove the least useful one).
+  - cv: Number of stratified folds (the same splits for every candidate and step).
+  - estimator: Classifier (default: LogisticRegression(max_iter=1000)).
+  - n_jobs: Number of parallel workers over the candidate features (-1: all CPUs, default: 1).
+  - backend: 'process' (the folds are sent once to each worker) or 'thread'.
+  - tol: If given, stop when the CV accuracy has not improved by at least tol over the best one for patience
+  steps, and return the subset with the best accuracy (default: None, select num_features features).
+  - patience: Number of steps without improvement before stopping.
+  - verbose: If True, print the accuracy and the time of each step.
+  Outputs:
+  - selected: Indices of the selected features (in the order they were added for "forward").
+  - history: Dictionary with the feature added/removed ("features"), the CV accuracy ("score") and the time
+  in seconds ("time") of each step.
+  ============================ Flowchart for the sequential_selection function ===============================
+  1. Start
+  2. Split the samples into cv stratified folds once, and standardize the training and test part of each fold
+  with the mean and standard deviation of its training part (all the features at once).
+  3. For each step, until num_features features are selected (or remain for "backward"):
+    a. Build the candidate subsets: the current subset plus (or minus) each remaining feature.
+    b. Compute the mean CV accuracy of every candidate in parallel; each worker only selects columns of the
+    standardized folds.
+    c. Keep the best candidate and record its feature, accuracy and time.
+    d. Stop early if the accuracy has plateaued for patience steps (tol).
+  4. Return the selected features and the history.
+  5. End.
+  ============================================================================================================
+  """
+  data = np.array(data) if not isinstance(data, np.ndarray) else data
+  labels = np.asarray(labels)
+  estimator = linear_model.LogisticRegression(max_iter=1000) if estimator is None else estimator
+  n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 0 else max(1, int(n_jobs))
+  if direction not in ("forward", "backward"):
+    raise ValueError(f"Unknown direction '{direction}', expected 'forward' or 'backward'")
+  # --------------------------------- Fixed folds, standardized once ---------------------------------------
+  folds = []
+  for train, test in model_selection.StratifiedKFold(cv).split(data, labels):
+    scaler = preprocessing.StandardScaler().fit(data[train])
+    folds.append((scaler.transform(data[train]), labels[train], scaler.transform(data[test]), labels[test]))
+
+  current = [] if direction == "forward" else list(range(data.shape[1]))
+  history = {"features": [], "score": [], "time": []}
+  best_score, best_subset, stall = -np.inf, list(current), 0
+  num_step = num_features if direction == "forward" else data.shape[1] - num_features
+  # ------------------------------------------ Sequential steps --------------------------------------------
+  pool = None
+  if n_jobs > 1 and backend == "process":
+    pool = ProcessPoolExecutor(n_jobs, initializer=_set_folds, initargs=(folds, estimator))
+  elif n_jobs > 1:
+    pool = ThreadPoolExecutor(n_jobs)
+  try:
+    for _ in range(num_step):
+      tic = time.perf_counter()
+      remaining = [i for i in range(data.shape[1]) if i not in current] if direction == "forward" else current
+      candidates = [sorted(current + [i]) if direction == "forward" else [j for j in current if j != i]
+                    for i in remaining]
+      if pool is None:
+        scores = [_cv_accuracy(val, folds, estimator) for val in candidates]
+      elif backend == "process":   # Only the column indices are sent to the workers
+        scores = list(pool.map(_cv_accuracy, candidates, chunksize=max(1, len(candidates) // (4 * n_jobs))))
+      else:
+        scores = list(pool.map(lambda val: _cv_accuracy(val, folds, estimator), candidates))
+      ind = int(np.argmax(scores))
+      feature = remaining[ind]
+      current = current + [feature] if direction == "forward" else candidates[ind]
+      history["features"].append(feature)
+      history["score"].append(scores[ind])
+      history["time"].append(time.perf_counter() - tic)
+      if verbose:
+        print(f"Step {len(history['score'])}: {len(current)} features, accuracy = {scores[ind]:.4f}, "
+              f"time = {history['time'][-1]:.2f} s")
+      # ------------------------------------------- Early stopping -------------------------------------------
+      if tol is None or scores[ind] >= best_score + tol:
+        best_score, best_subset, stall = scores[ind], list(current), 0
+      else:
+        stall += 1
+        if stall >= patience:
+          break
+  finally:
+    if pool is not None:
+      pool.shutdown()
+
+  return np.array(best_subset if tol is not None else current, dtype=int), history
+
+
+_FOLDS = None   # Standardized folds and estimator of a worker process (set once by _set_folds)
+
+
+def _set_folds(folds, estimator):
+  global _FOLDS
+  _FOLDS = (folds, estimator)
+
+
+def _cv_accuracy(columns, folds=None, estimator=None):
+  # Mean accuracy of the estimator on the standardized folds restricted to columns
+  folds, estimator = (folds, estimator) if folds is not None else _FOLDS
+  accuracy = [np.mean(base.clone(estimator).fit(x_train[:, columns], y_train).predict(x_test[:, columns])
+                      == y_test) for x_train, y_train, x_test, y_test in folds]
+
+  return float(np.mean(accuracy))
+
+
+# ============================================== One-way ANOVA ===============================================
+def anova_f(data, labels):
+  """
+  One-way ANOVA of every feature between the classes of labels, in a single pass over the data (same values
+  as scipy.stats.f_oneway applied to each feature grouped by class).
+  Inputs:
+  - data: The feature matrix with dimensions (number of samples, number of features).
+  - labels: The labels corresponding to each sample.
+  Outputs:
+  - f_stat: F statistic of each feature.
+  - pvalue: p-value of each feature.
+  """
+  data = np.asarray(data, dtype=float)
+  _, classes = np.unique(labels, return_inverse=True)
+  one_hot = np.eye(classes.max() + 1)[classes.ravel()].T  # (classes, samples)
+  num_sample, num_class = len(classes), one_hot.shape[0]
+  # ---------------- Per-class sums and sums of squares of the centered features (classes, features) ---------
+  data = data - np.mean(data, axis=0)
+  count = one_hot.sum(axis=1)[:, np.newaxis]
+  sums = one_hot @ data
+  ss_total = np.sum(data ** 2, axis=0)                      # The total mean of the centered data is 0
+  ss_between = np.sum(sums ** 2 / count, axis=0)
+  ss_within = ss_total - ss_between
+  # ------------------------------------------ F statistic and p-value ---------------------------------------
+  df_between, df_within = num_class - 1, num_sample - num_class
+  with np.errstate(divide="ignore", invalid="ignore"):      # Constant features, as in f_oneway
+    f_stat = (ss_between / df_between) / (np.maximum(ss_within, 0) / df_within)
+  pvalue = stats.f.sf(f_stat, df_between, df_within)
+
+  return f_stat, pvalue
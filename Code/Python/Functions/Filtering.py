@@ -1,16 +1,17 @@
 import numpy as np
-from scipy import signal
+from scipy import signal, fft
+from functools import lru_cache
 
 # =============================================== Filtering ==================================================
 # Function to apply digital filtering to data
 def filtering(data, f_low, f_high, order, fs, notch_freq, quality_factor, filter_active="on", notch_filter="on",
-              type_filter='bandpass', design_method="IRR"):
+              type_filter='bandpass', design_method="IRR", axis=None, out=None):
     """
     =============================== Presented by: Reza Saadatyar (2023-2024) =================================
     ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
     Example:
     fs = 256;                  % Sampling frequency
-    order = 3; 
+    order = 3;
     f_low = 0.5;
     f_high = 100;
     notch_freq = 50;
@@ -18,9 +19,11 @@ def filtering(data, f_low, f_high, order, fs, notch_freq, quality_factor, filter
     filter_active = 'on';
     design_method = "IIR";      % IIR, FIR
     type_filter = "bandpass";   % low, high, bandpass
-    filtered_data = filtering(data_total, f_low, f_high, order, fs, notch_freq, filter_active,  notch_filter, 
+    filtered_data = filtering(data_total, f_low, f_high, order, fs, notch_freq, filter_active,  notch_filter,
                               type_filter, design_method)
-                              
+    filtered_data = filtering(data_total, f_low, f_high, order, fs, notch_freq, filter_active,  notch_filter,
+                              type_filter, design_method, axis=0)   % Time along axis 0, no transpose
+
     FILTERING applies digital filtering to data.
     Inputs:
     - data: Input data to be filtered.
@@ -33,74 +36,273 @@ def filtering(data, f_low, f_high, order, fs, notch_freq, quality_factor, filter
     - filter_active: Activate filtering ('on' or 'off').
     - notch_filter: Activate notch filtering ('on' or 'off').
     - type_filter: Type of filter ('low', 'high', 'bandpass', 'stop').
+    - axis: Time axis of the data. If None (default), the time axis is guessed from the shape and the output
+    has more rows than columns, as in previous versions.
+    - out: Optional array that receives the result (out=data filters in place).
     Output:
-    - filtered_data: Filtered data.
+    - filtered_data: Filtered data (float32 input stays float32).
     ================================== Flowchart for the filtering function ==================================
     Start
-    1. Normalize the frequency values by dividing them by half the sampling frequency 
-    (Nyquist frequency).
-    2. Transpose the data if it has more rows than columns or if specified by the user.
-    3. Design the filter based on the specified parameters and filter type:
+    1. Find the time axis: the given axis, or the rows if the data has more rows than columns and the last
+    axis otherwise.
+    2. Get the filter from the cached design registry (filter_design) based on the specified parameters:
         a. If the design method is IIR:
-        - Design Butterworth filter using the 'butter' function.
+        - Butterworth filter as second-order sections (SOS).
         b. If the design method is FIR:
-        - Design FIR filter using the 'fir1' function. 
-    4. Design a notch filter if specified by the user using the 'butter' function.
-    5. Apply the notch filter to the data if specified by the user using 'filtfilt'.
-    6. Apply the designed filter to the data if active using 'filtfilt'.
-    7. Return the filtered data.
+        - FIR filter taps from the 'firwin' function.
+    3. Get the notch filter as second-order sections from the registry.
+    4. Apply the notch filter if specified by the user, to all channels and trials in a single zero-phase call
+    along the time axis.
+    5. Apply the designed filter if active, in a single zero-phase call along the time axis (fir_filter for
+    FIR filters).
+    6. If out is given, filter the data block by block (along the last axis that is not the time axis) and
+    write each block into out, so only the temporaries of one block are allocated.
+    7. Return the filtered data (with more rows than columns if axis is None).
     End
     ==========================================================================================================
     """
-    # ---------------------------------------- Normalize frequency values ------------------------------------
-    f_low = f_low / (fs / 2)
-    f_high = f_high / (fs / 2)
-    
-    filtered_data = data.copy()           # Make a copy of the input data
     # ----------------------------- Convert data to ndarray if it's not already ------------------------------
-    filtered_data = np.array(filtered_data) if not isinstance(filtered_data, np.ndarray) else filtered_data
-    # ------------------------- Transpose data if it has more rows than columns ------------------------------
-    filtered_data = filtered_data.T if filtered_data.ndim > 1 and filtered_data.shape[0] > filtered_data.shape[-1]\
-    else filtered_data
+    data = np.asarray(data)
+    data = data.astype(float) if data.dtype not in (np.float32, np.float64) else data
+    # ---------------------------------------------- Time axis -----------------------------------------------
+    legacy = axis is None
+    if legacy:   # Time along the rows if the data has more rows than columns, along the last axis otherwise
+        axis = 0 if data.ndim > 1 and data.shape[0] > data.shape[-1] else -1
     # ------------------------- Design Butterworth filter based on the specified type ------------------------
-    if design_method == "IIR":
-        if type_filter == "low":     
-            b, a = signal.butter(order, f_low, btype='low')
-        elif type_filter == "high":
-            b, a = signal.butter(order, f_high, btype='high')
-        elif type_filter == "bandpass":
-            b, a = signal.butter(order, [f_low, f_high], btype='bandpass')
-        elif type_filter == "bandstop":
-            b, a = signal.butter(order, [f_low, f_high], btype='bandstop')
+    band = {"low": f_low, "high": f_high}.get(type_filter, [f_low, f_high])
+    if design_method == "IIR":   # Designs come from the cached registry (a dict lookup after the first call)
+        sos = filter_design(type_filter, order, band, fs, "IIR").astype(data.dtype)
     else:
-        a = 1
-        if type_filter == "low":     
-            b = signal.firwin(order, f_low, pass_zero='lowpass')
-        elif type_filter == "high":
-            b = signal.firwin(order, f_high, pass_zero='highpass')
-        elif type_filter == "bandpass":
-            b = signal.firwin(order, [f_low, f_high], pass_zero='bandpass')
-        elif type_filter == "bandstop":
-            b = signal.firwin(order, [f_low, f_high], pass_zero='bandstop')
+        b = filter_design(type_filter, order, band, fs, "FIR").astype(data.dtype)
     
     # Design a notch filter using signal.iirnotch
-    b_notch, a_notch = signal.iirnotch(notch_freq, quality_factor, fs)
-    # ------------------------------------------ Notch filter ------------------------------------------------
-    if notch_filter == "on":
-        if filtered_data.ndim == 3:
-            for i in range(filtered_data.shape[0]):
-                filtered_data[i, :, :] = signal.filtfilt(b_notch, a_notch, filtered_data[i, :, :])
-        else:
-            filtered_data = signal.filtfilt(b_notch, a_notch, filtered_data)
-     # ------------------ Apply the digital filter using filtfilt to avoid phase distortion ------------------
-    if filter_active == "on":
-        if filtered_data.ndim == 3:
-            for i in range(filtered_data.shape[0]):
-                filtered_data[i, :, :] = signal.filtfilt(b, a, filtered_data[i, :, :])
-        else:
-            filtered_data = signal.filtfilt(b, a, filtered_data)
+    sos_notch = filter_design("notch", 2, (notch_freq, quality_factor), fs).astype(data.dtype)
+
+    def apply_filters(filtered_data):
+        # ---------------------------------------- Notch filter ----------------------------------------------
+        if notch_filter == "on":   # All channels and trials in a single call along the time axis
+            filtered_data = signal.sosfiltfilt(sos_notch, filtered_data, axis=axis)
+        # ---------------- Apply the digital filter using filtfilt to avoid phase distortion -----------------
+        if filter_active == "on":
+            if design_method == "IIR":
+                filtered_data = signal.sosfiltfilt(sos, filtered_data, axis=axis)
+            else:   # Direct, overlap-add or FFT convolution depending on the number of taps and samples
+                filtered_data = fir_filter(b, filtered_data, axis=axis)
+        return filtered_data
+
+    if out is None:
+        filtered_data = apply_filters(data)
+        filtered_data = data.copy() if filtered_data is data else filtered_data   # Never return the input
+    else:   # Filter block by block and write each block into out: the temporaries are one block only
+        for block in _blocks(data.shape, axis):
+            out[block] = apply_filters(data[block])
+        filtered_data = out
     # --------------------------- Transpose data if it has more columns than rows ----------------------------
-    filtered_data = filtered_data.T if filtered_data.ndim > 1 and filtered_data.shape[0] < filtered_data.shape[-1]\
-    else filtered_data
+    if legacy and filtered_data.ndim > 1 and filtered_data.shape[0] < filtered_data.shape[-1]:
+        filtered_data = filtered_data.T
+
+    return filtered_data
+
+
+# ========================================== Filter design registry ==========================================
+NUM_TAPS_FFT = 64   # fir_filter (method 'auto'): FIR filters with at least this many taps use FFT convolution
+NUM_OA_RATIO = 128  # and overlap-add if the signal is more than NUM_OA_RATIO times longer than the filter
+NUM_BLOCK = 2 ** 20  # filtering with out: maximum number of values of each block filtered at once
+
+
+def filter_design(type_filter, order, band, fs, design_method="IIR"):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Memoized filter design keyed by (type, order, band, fs, method).
+    Inputs:
+    - type_filter: Type of filter ('low', 'high', 'bandpass', 'bandstop' or 'notch').
+    - order: Filter order (IIR) or number of taps (FIR); ignored for 'notch'.
+    - band: Cutoff frequency, [f_low, f_high] for band filters, or (notch_freq, quality_factor) for 'notch'.
+    - fs: Sampling frequency.
+    - design_method: 'IIR' (Butterworth) or 'FIR' (firwin); ignored for 'notch'.
+    Output:
+    - design: Second-order sections with dimensions (number of sections, 6) for IIR and notch filters, or the
+    FIR taps. The array is shared by every caller with the same key and must not be modified.
+    ==========================================================================================================
+    """
+    band = tuple(float(val) for val in np.ravel(band))
+    band = band[0] if len(band) == 1 else band
+    design_method = "IIR" if type_filter == "notch" else design_method
+
+    return _filter_design(type_filter, int(order), band, float(fs), design_method)
+
+
+@lru_cache(maxsize=256)
+def _filter_design(type_filter, order, band, fs, design_method):
+    if type_filter == "notch":
+        return signal.tf2sos(*signal.iirnotch(band[0], band[1], fs))
+    elif design_method == "IIR":   # Second-order sections stay stable for high orders and narrow bands
+        return signal.butter(order, band, btype=type_filter, fs=fs, output="sos")
+    
+    pass_zero = {"low": "lowpass", "high": "highpass"}.get(type_filter, type_filter)   # Names of firwin
+
+    return signal.firwin(order, band, pass_zero=pass_zero, fs=fs)
+
+
+def _blocks(shape, axis):
+    # Slices of blocks of at most NUM_BLOCK values along the last axis that is not the time axis
+    axis = axis % len(shape)
+    block_axis = max((val for val in range(len(shape)) if val != axis), default=None)
+    if block_axis is None:
+        return [(slice(None),)]
+    step = max(1, NUM_BLOCK // (int(np.prod(shape)) // shape[block_axis] or 1))
+    index = [slice(None)] * len(shape)
+
+    return [tuple(index[:block_axis] + [slice(start, start + step)] + index[block_axis + 1:])
+            for start in range(0, shape[block_axis], step)]
+
+
+# =========================================== FIR execution engine ===========================================
+def fir_filter(b, data, axis=-1, zero_phase=True, method="auto"):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Example:
+    b = filter_design("bandpass", 301, [6, 40], fs, "FIR")
+    filtered_data = fir_filter(b, data, axis=0)                  % Zero-phase, same as signal.filtfilt(b, 1, data)
+    filtered_data = fir_filter(b, data, axis=0, zero_phase=False, method="oa")   % Causal, overlap-add
+
+    FIR_FILTER applies an FIR filter to all channels and trials in one batched call along the time axis.
+    Inputs:
+    - b: FIR filter taps.
+    - data: Input data to be filtered.
+    - axis: Time axis of the data.
+    - zero_phase: If True, forward-backward filtering with the edge padding of signal.filtfilt; otherwise a
+    causal filter with zero initial conditions (same as signal.lfilter(b, 1, data)).
+    - method: 'direct' (signal.lfilter), 'fft' (one FFT block over the whole signal), 'oa' (overlap-add, 
+    signal.oaconvolve) or 'auto'.
+    Output:
+    - filtered_data: Filtered data with the dtype of data.
+    ================================= Flowchart for the fir_filter function ==================================
+    Start
+    1. Choose the method if 'auto':
+        a. direct if the filter has fewer than NUM_TAPS_FFT taps.
+        b. oa if the signal is more than NUM_OA_RATIO times longer than the filter (bounded FFT size).
+        c. fft otherwise.
+    2. Move the time axis to the end and, if zero_phase, pad both edges with the odd extension of filtfilt.
+    3. Forward pass: convolution with the taps.
+    4. If zero_phase, backward pass: correlation with the taps (convolution of the time-reversed signal), and
+    remove the padding.
+    5. Return the filtered data with the time axis at its original position.
+    End
+    ==========================================================================================================
+    """
+    data = np.asarray(data)
+    b = np.asarray(b, dtype=data.dtype)
+    num_tap, num_sample = len(b), data.shape[axis]
+    if method == "auto":
+        method = "direct" if num_tap < NUM_TAPS_FFT else "oa" if num_sample > NUM_OA_RATIO * num_tap else "fft"
+    elif method not in ("direct", "fft", "oa"):
+        raise ValueError(f"Unknown FIR method '{method}', expected 'direct', 'fft', 'oa' or 'auto'")
+
+    padlen = 3 * num_tap if zero_phase else 0   # Same odd extension as filtfilt
+    if zero_phase and num_sample <= padlen:
+        return signal.filtfilt(b, np.ones(1, dtype=data.dtype), data, axis=axis)
+
+    x = np.moveaxis(data, axis, -1)
+    if not zero_phase:
+        return np.moveaxis(_fir_convolve(b, x, method), -1, axis)
+
+    ext = np.concatenate((2 * x[..., :1] - x[..., padlen:0:-1], x, 
+                          2 * x[..., -1:] - x[..., -2:-padlen - 2:-1]), axis=-1)
+    # filtfilt's initial conditions only change the first and last num_tap - 1 samples, which lie in the padding
+    filtered_data = _fir_convolve(b, _fir_convolve(b, ext, method), method, correlate=True)
+
+    return np.moveaxis(filtered_data[..., padlen:-padlen], -1, axis)
+
+
+def _fir_convolve(b, x, method, correlate=False):
+    # Convolution (y[n] = sum b[k] x[n - k]) or correlation (y[n] = sum b[k] x[n + k]) along the last axis, 
+    # with zeros outside the signal; the output has the length of x
+    num_tap, num_sample = len(b), x.shape[-1]
+    if method == "direct":
+        if correlate:
+            return signal.lfilter(b, np.ones(1, dtype=x.dtype), x[..., ::-1], axis=-1)[..., ::-1]
+        return signal.lfilter(b, np.ones(1, dtype=x.dtype), x, axis=-1)
+    elif method == "oa":
+        kernel = (b[::-1] if correlate else b).reshape((1,) * (x.ndim - 1) + (-1,))
+        out = signal.oaconvolve(x, kernel, mode="full", axes=-1)
+        return out[..., num_tap - 1:] if correlate else out[..., :num_sample]
+    else:   # fft
+        num_fft = fft.next_fast_len(num_sample + num_tap - 1, real=True)   # No circular wrap-around
+        b_fft = fft.rfft(b, num_fft)
+        out = fft.irfft(fft.rfft(x, num_fft, axis=-1) * (b_fft.conj() if correlate else b_fft), num_fft, axis=-1)
+        return out[..., :num_sample]
+
+
+# ============================================= Streaming filter =============================================
+class StreamingFilter:
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Causal band-pass/notch filter for online use that keeps its state between chunks.
+    Parameters:
+    - f_low: Low cutoff frequency.
+    - f_high: High cutoff frequency.
+    - order: Filter order.
+    - fs: Sampling frequency.
+    - notch_freq: Frequency to be notched out.
+    - quality_factor: Quality factor for the notch filter.
+    - filter_active: Activate filtering ('on' or 'off').
+    - notch_filter: Activate notch filtering ('on' or 'off').
+    - type_filter: Type of filter ('low', 'high', 'bandpass', 'bandstop').
+    Usage:
+    - stream_filter = StreamingFilter(f_low, f_high, order, fs, notch_freq, quality_factor)
+    - filtered_chunk = stream_filter.process(chunk)  # chunk: (number of samples, number of channels)
+    ============================== Flowchart for the StreamingFilter class ===================================
+    Start
+    1. Design the Butterworth filter and the notch filter once as second-order sections (SOS) and cascade them.
+    2. For the first chunk, initialize the state zi of each channel to the steady state of its first sample 
+    (no edge transient).
+    3. Filter every chunk causally with sosfilt along the time axis, starting from the stored state zi.
+    4. Store the final state zi for the next chunk and write the result into out (if given).
+    End
+    ==========================================================================================================
+    """
+    def __init__(self, f_low, f_high, order, fs, notch_freq, quality_factor, filter_active="on", 
+                 notch_filter="on", type_filter="bandpass"):
+        # -------------------------------- Design the SOS cascade (only once) --------------------------------
+        sos = []
+        if filter_active == "on":
+            band = {"low": f_low, "high": f_high}.get(type_filter, [f_low, f_high])
+            sos.append(filter_design(type_filter, order, band, fs, "IIR"))
+        if notch_filter == "on":
+            sos.append(filter_design("notch", 2, (notch_freq, quality_factor), fs))
+        
+        self.sos = np.vstack(sos) if sos else np.array([[1.0, 0, 0, 1.0, 0, 0]])  # Identity section if off
+        self.zi = None
+
+    def reset(self):
+        """
+        Clear the filter state (the next chunk starts a new recording).
+        """
+        self.zi = None
+
+    def process(self, chunk, out=None):
+        """
+        Filter a chunk with dimensions (number of samples, number of channels) or (number of samples,).
+        Parameters:
+        - chunk: New samples of the recording.
+        - out: Optional preallocated array with the same shape as chunk that receives the result.
+        Output:
+        - filtered_chunk: Filtered samples (out if given).
+        """
+        chunk = np.asarray(chunk, dtype=float)
+        if chunk.shape[0] == 0:
+            return chunk if out is None else out
+        if self.zi is None:   # Steady-state initial condition for the first sample of each channel
+            zi = signal.sosfilt_zi(self.sos)
+            self.zi = zi.reshape(zi.shape + (1,) * (chunk.ndim - 1)) * chunk[0]
+        
+        filtered_chunk, self.zi = signal.sosfilt(self.sos, chunk, axis=0, zi=self.zi)
+        if out is not None:
+            out[...] = filtered_chunk
+            return out
 
-    return filtered_data
\ No newline at end of file
+        return filtered_chunk
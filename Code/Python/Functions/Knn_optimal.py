@@ -1,6 +1,8 @@
+import os
 import numpy as np
-from sklearn import neighbors
 import matplotlib.pyplot as plt
+from sklearn import metrics, model_selection
+from concurrent.futures import ThreadPoolExecutor
 
 # ============================================= KNN_optimal ==================================================  
 def knn_optimal(data_train, label_train, data_test, label_test, display_optimal_k="off", n=21, fig_size=(3.5, 2.5)):
@@ -24,10 +26,12 @@ def knn_optimal(data_train, label_train, data_test, label_test, display_optimal_
         a. If true, transpose the training and test data matrices.
     3. Initialize an array t from 1 to n - 1, where n is the specified maximum number of neighbors.
     4. Initialize arrays for storing training and test accuracies for different values of k.
-    5. Iterate over values of k from 1 to n - 1:
-        a. Create a KNN classifier with Minkowski distance metric and k neighbors.
-        b. Fit the model on the training data and calculate the training accuracy.
-        c. Evaluate the model on the test data and calculate the test accuracy.
+    5. Compute the training and test accuracies of every k from 1 to n - 1 in a single sweep (knn_sweep):
+        a. Compute the Minkowski (Euclidean) distances of the training and test data to the training data.
+        b. Select the n - 1 nearest neighbors once (partial selection, ties with the (n - 1)-th distance
+        included) and sort only them by distance, with tied neighbors in the order of the training samples.
+        c. Count the votes of each class cumulatively over the neighbors, so the prediction for k is the
+        class with the most votes among the first k neighbors (ties go to the smallest class, as in sklearn).
     6. If display_optimal_k is set to "on":
         a. Plot the training and test accuracies against the number of neighbors.
         b. Set x-axis ticks to the values of t.
@@ -42,13 +46,8 @@ def knn_optimal(data_train, label_train, data_test, label_test, display_optimal_
         data_train = data_train.T
         data_test = data_test.T
     t = np.arange(1, n)
-    accuracy_train = np.zeros(n-1)
-    accuracy_test = np.zeros(n-1)
-    for i in range(1 , n):
-        model = neighbors.KNeighborsClassifier(metric='minkowski', n_neighbors=i)
-        model.fit(data_train, label_train)
-        accuracy_train[i-1] = model.score(data_train, label_train)
-        accuracy_test[i-1] = model.score(data_test, label_test)
+    accuracy_train, accuracy_test = knn_sweep(data_train, label_train, [data_train, data_test],
+                                              [label_train, label_test], n)
     
     if display_optimal_k == "on":
         
@@ -63,4 +62,94 @@ def knn_optimal(data_train, label_train, data_test, label_test, display_optimal_
         plt.title(f"Optimal_k for KNN: {t[np.argmax(accuracy_test)]}", fontsize=10)
         plt.tick_params(axis='x', rotation=90)
 
-    return t[np.argmax(accuracy_test)]
\ No newline at end of file
+    return t[np.argmax(accuracy_test)]
+
+
+# ============================================== KNN sweep ===================================================
+def knn_sweep(data_train, label_train, data_eval, label_eval, n=21):
+    """
+    Accuracy of the KNN classifier (Minkowski distance) for every k from 1 to n - 1 from a single partial
+    neighbor selection.
+    Inputs:
+    - data_train: Training data features (number of samples, number of features).
+    - label_train: Labels of the training data.
+    - data_eval: Data to evaluate, or a list of data sets (e.g., [data_train, data_test]).
+    - label_eval: Labels of data_eval (or a list of labels).
+    - n: Maximum number of neighbors to consider (k < n).
+    Output:
+    - accuracy: Accuracy for k = 1, ..., n - 1, or a list with one such array for each data set.
+    Note: neighbors at the same distance are taken in the order of the training samples, so the neighbors of
+    k are always the first k of the neighbors of k + 1. sklearn (kd-tree/ball-tree) picks among tied neighbors
+    arbitrarily and not consistently across k; with tied distances (discrete or duplicated features) the
+    accuracies can therefore differ from KNeighborsClassifier(n_neighbors=k).score. They are equal without
+    ties.
+    """
+    data_train = np.asarray(data_train, dtype=float)
+    classes, train_class = np.unique(label_train, return_inverse=True)   # Class index of each training sample
+    sets = zip(data_eval, label_eval) if isinstance(data_eval, list) else [(data_eval, label_eval)]
+    chunk = max(1, 2 ** 22 // len(data_train))                          # Rows of distances per block
+    accuracy = []
+    for data, labels in sets:
+        data = np.asarray(data, dtype=float)
+        # Neighbors sorted by distance, then by training sample: (samples, n - 1)
+        ind = np.concatenate([_nearest(metrics.pairwise_distances(data[i:i + chunk], data_train), n - 1)
+                              for i in range(0, len(data), chunk)])
+        # Cumulative votes of each class over the first k neighbors: (samples, n - 1, classes)
+        votes = np.cumsum(np.eye(len(classes), dtype=np.int32)[train_class[ind]], axis=1)
+        predict = classes[np.argmax(votes, axis=2)]  # First maximum: smallest class on ties
+        accuracy.append(np.mean(predict == np.asarray(labels)[:, np.newaxis], axis=0))
+
+    return accuracy if isinstance(data_eval, list) else accuracy[0]
+
+
+def _nearest(dist, num_neighbors):
+    # Indices of the num_neighbors nearest training samples of each row of dist, sorted by distance and then
+    # by training sample, from a partial selection: only the candidates up to the num_neighbors-th distance
+    # (ties included) are sorted
+    num_neighbors = min(num_neighbors, dist.shape[1])
+    kth = np.partition(dist, num_neighbors - 1, axis=1)[:, num_neighbors - 1:num_neighbors]
+    rows, cols = np.nonzero(dist <= kth)                  # Candidates, in the order of the training samples
+    order = np.lexsort((cols, dist[rows, cols], rows))    # By row, then by distance, then by training sample
+    start = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(dist)))[:-1]))
+
+    return cols[order][start[:, np.newaxis] + np.arange(num_neighbors)]
+
+
+# =========================================== KNN optimal (CV) ===============================================
+def knn_optimal_cv(data, labels, n=21, cv=5, n_jobs=1):
+    """
+    ================================ Presented by: Reza Saadatyar (2023-2024) ================================
+    ================================= E-mail: Reza.Saadatyar@outlook.com =====================================
+    Optimal number of neighbors (k) of a k-Nearest Neighbors classifier by cross-validation.
+    Inputs:
+    - data: Data features (number of samples, number of features).
+    - labels: Labels of the data.
+    - n: Maximum number of neighbors to consider (k < n).
+    - cv: Number of stratified folds.
+    - n_jobs: Number of folds evaluated in parallel (-1: all CPUs, default: 1).
+    Outputs:
+    - optimal_k: Number of neighbors with the maximum mean validation accuracy.
+    - accuracy: Mean validation accuracy for k = 1, ..., n - 1.
+    ============================== Flowchart for the knn_optimal_cv function =================================
+    1. Start.
+    2. Split the data into cv stratified folds.
+    3. For each fold (in parallel), compute the validation accuracy of every k with a single sweep
+    (knn_sweep).
+    4. Average the accuracies over the folds.
+    5. Return the k with the maximum mean accuracy (the smallest one on ties) and the mean accuracies.
+    6. End.
+    ==========================================================================================================
+    """
+    data, labels = np.asarray(data), np.asarray(labels)
+    n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 0 else max(1, int(n_jobs))
+    folds = list(model_selection.StratifiedKFold(cv).split(data, labels))
+
+    def fold_accuracy(fold):
+        train, test = fold
+        return knn_sweep(data[train], labels[train], data[test], labels[test], n)
+
+    # Threads: the neighbor search releases the GIL
+    with ThreadPoolExecutor(max_workers=min(n_jobs, len(folds))) as pool:
+        accuracy = np.mean(list(pool.map(fold_accuracy, folds)), axis=0)
+
+    return np.arange(1, n)[np.argmax(accuracy)], accuracy
@@ -1,7 +1,11 @@
 import numpy as np
+from functools import lru_cache
+from .Canonical_correlation import inv_sqrtm
+from .Reference_signal import reference_signal
+from .Parallel import parallel_trials
 
 # ================================ Multivariate synchronization index (MSI) ==================================
-def msi(data, fs, f_stim, num_channel, num_harmonic):
+def msi(data, fs, f_stim, num_channel, num_harmonic, n_jobs=1, chunk_size=None, backend="process"):
     """
     Parameters:
     - data: EEG data matrix with dimensions (number of samples, number of channels, number of trials).
@@ -9,25 +13,18 @@ def msi(data, fs, f_stim, num_channel, num_harmonic):
     - f_stim: Array of frequencies for stimulation.
     - num_channel: Index of the channel to analyze.
     - num_harmonic: Number of harmonic frequencies for each stimulation frequency.
+    - n_jobs: Number of parallel workers over the trials (-1: all CPUs, default: 1).
+    - chunk_size: Number of trials of each chunk (default: the trials split evenly over the workers).
+    - backend: Workers of parallel_trials, 'process' (default) or 'thread'.
      ===================================== Flowchart for the msi function ====================================
     Start
     1. Convert data to a numpy array if it's not already in that format.
     2. Transpose the data if necessary to ensure proper dimensions.
-    3. Initialize an empty list data_ref to store reference signals.
-    4. Generate a time vector based on the sampling frequency.
-    5. Iterate over each stimulation frequency (val) in f_stim:
-        a. Initialize an empty list signal_ref to store reference signals for the current stimulation frequency.
-        b. Generate sine and cosine signals for each harmonic frequency and append them to signal_ref.
-        c. Stack the sine and cosine signals along the second axis to form the reference signal.
-        d. Append the reference signal to data_ref.
-    6. Initialize an array predict_label to store predicted labels for each trial.
-    7. Iterate over each trial (i) in the EEG data:
-        a. Initialize an array coeff to store correlation coefficients.
-        b. Iterate over each stimulation frequency (k) and its index:
-            i. Perform MSI analysis between the data for the current trial and the reference signal.
-            ii. Store the MSI coefficient in the coeff array.
-        c. Predict the label for the current trial based on the maximum MSI coefficient.
-    8. Return the array of predicted labels.
+    3. Get the reference signals of all stimulation frequencies from the cached reference bank.
+    4. Compute the synchronization index of all trials and stimulation frequencies at once (msi_batch, with
+    the trials split over n_jobs workers).
+    5. Predict the label of each trial based on the maximum MSI coefficient.
+    6. Return the array of predicted labels.
     End
     ==========================================================================================================
     """
@@ -37,29 +34,12 @@ def msi(data, fs, f_stim, num_channel, num_harmonic):
     # Transpose the data if it has more than one dimension and has fewer rows than columns
     data = data.T if data.ndim > 1 and data.shape[0] < data.shape[-1] else data
     # ---------------------------------------- Reference signal ----------------------------------------------
-    data_ref = []
-    time = np.linspace(0, data.shape[0] / fs, data.shape[0])  # Time vector
-    
-    for _, val in enumerate(f_stim): # First loop: frequencies stimulation
-
-        signal_ref = []
-
-        for j in range(1, num_harmonic + 1):  # Generate a reference signal for each frequency stimulation
-            signal_ref.append(np.sin(2 * np.pi * j * val * time))
-            signal_ref.append(np.cos(2 * np.pi * j * val * time))
-
-        data_ref.append(np.stack(signal_ref, axis=1))  # Store data_ref in the data_ref_list
+    data_ref = reference_signal(fs, data.shape[0], f_stim, num_harmonic)  # Cached reference bank
     # --------------------------------------- Correlation Analysis -------------------------------------------
-    predict_label = np.zeros(data.shape[-1])  # Initialize predict_label array with zeros
-    
-    for i in range(data.shape[-1]): # Loop through all Trials
-        
-        coeff = np.zeros(len(f_stim))
-
-        for k in range(len(f_stim)):  # Second loop: Calculate MSI for frequencies stimulation
-            coeff[k] = msi_analysis(data[:, num_channel, i], data_ref[k]) 
-        
-        predict_label[i] = np.argmax(coeff) # Predict label for the current trial
+    # Synchronization indices (trials, frequencies)
+    coeff = parallel_trials(msi_batch, data, data_ref, num_channel, n_jobs=n_jobs, chunk_size=chunk_size,
+                            backend=backend)
+    predict_label = np.argmax(coeff, axis=1).astype(float)   # Predict label for each trial
   
     return predict_label
 
@@ -77,26 +57,8 @@ def msi_analysis(data, data_ref):
     Start
     1. Convert data and data_ref to numpy arrays if they are not already in that format.
     2. Transpose the data if necessary to ensure proper dimensions.
-    3. Calculate the number of channels in the data.
-    4. Compute the covariance matrix c of the concatenated data and reference signal.
-    5. Split the covariance matrix into submatrices:
-        a. c1: Covariance matrix of the EEG data.
-        b. c2: Covariance matrix of the reference signal.
-        c. c12: Cross-covariance matrix between EEG data and reference signal.
-        d. c21: Transpose of c12.
-    6. Set negative values in c1 and c2 to zero to ensure positive semi-definiteness.
-    7. Compute the transformed correlation matrices:
-        a. r1: Identity matrix corresponding to the EEG data.
-        b. r2: Identity matrix corresponding to the reference signal.
-        c. r12: Transformed correlation matrix between EEG data and reference signal.
-        d. r21: Transformed correlation matrix between the reference signal and EEG data.
-        e. r: Stack r1, r12, r21, and r2 to form the complete transformed correlation matrix.
-    8. Compute the eigenvalues of the transformed correlation matrix.
-    9. Set any negative eigenvalues to a small positive value (eps).
-    10. Normalize the eigenvalues by dividing each by the sum of all eigenvalues.
-    11. Calculate the synchronization index (s) between the EEG data and the reference signal using the 
-    normalized eigenvalues.
-    12. Return the synchronization index (s).
+    3. Compute the synchronization index with msi_batch (a single trial and a single reference signal).
+    4. Return the synchronization index (s).
     End
     ==========================================================================================================
     """
@@ -105,32 +67,95 @@ def msi_analysis(data, data_ref):
 
     # Transpose the data if it has more than one dimension and has fewer rows than columns
     data, data_ref = [x.T if x.ndim > 1 and x.shape[0] < x.shape[-1] else x for x in [data, data_ref]]
-    # --------------------------------- Calculate covariance matrices ----------------------------------------
-    num_channel = data.shape[1]
-    c = np.cov(np.hstack((data, data_ref)), rowvar=False)
-    c1 = c[:num_channel, :num_channel]
-    c2 = c[num_channel:, num_channel:]
-    c12 = c[:num_channel, num_channel:]
-    c21 = c[num_channel:, :num_channel]
-    c1[c1 < 0], c2[c2 < 0] = 0, 0
+    data, data_ref = [x[:, np.newaxis] if x.ndim == 1 else x for x in [data, data_ref]]
+
+    return msi_batch(data, data_ref)[0, 0]
+
+
+# ============================================ Batched MSI ===================================================
+def msi_batch(data, data_ref, num_channel=None):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Synchronization indices between every trial and every reference signal in a few batched calls.
+    Parameters:
+    - data: EEG data matrix with dimensions (number of samples, number of channels, number of trials).
+    - data_ref: Stacked reference signals with dimensions (number of frequencies, number of samples,
+    2 * number of harmonics).
+    - num_channel: Index of the channels to analyze (default: all channels).
+    Output:
+    - s: Synchronization indices with dimensions (number of trials, number of frequencies).
+    ================================= Flowchart for the msi_batch function ===================================
+    Start
+    1. Convert data and data_ref to NumPy arrays, transpose the data if it has fewer rows than columns and add
+    a trial axis to a single trial.
+    2. Select the channels and remove the mean of every channel and reference signal.
+    3. Compute the covariance matrices c1 of all trials and whiten them with the symmetric inverse square root
+    c1^(-1/2) (once per trial, for all frequencies).
+    4. Get the whitened reference signals Y c2^(-1/2) of every frequency from the cache (computed once).
+    5. Compute the whitened cross-correlations r12 = c1^(-1/2) c12 c2^(-1/2) of all trials and frequencies in
+    a single matrix product and build the correlation matrices r = [[I, r12], [r12^T, I]].
+    6. Compute the eigenvalues of all correlation matrices with the symmetric solver (eigvalsh).
+    7. Normalize the eigenvalues and return S = 1 + sum(l * log(l)) / log(number of channels + references).
+    End
+    ==========================================================================================================
+    """
+    # ----------------------------- Convert data to ndarray if it's not already ------------------------------
+    data = np.array(data) if not isinstance(data, np.ndarray) else data
+    data_ref = np.array(data_ref) if not isinstance(data_ref, np.ndarray) else data_ref
+
+    # Transpose the data if it has more than one dimension and has fewer rows than columns
+    data = data.T if data.ndim > 1 and data.shape[0] < data.shape[-1] else data
+    data = data[:, :, np.newaxis] if data.ndim == 2 else data          # A single trial
+    data_ref = data_ref[np.newaxis] if data_ref.ndim == 2 else data_ref  # A single stimulation frequency
+    data = data[:, num_channel, :] if num_channel is not None else data
+    # ------------------------------------------ Whitened signals --------------------------------------------
+    x = np.transpose(data - np.mean(data, axis=0), (2, 0, 1)).astype(float)   # (trials, samples, channels)
+    c1 = np.swapaxes(x, 1, 2) @ x / (x.shape[1] - 1)
+    x_white = x @ inv_sqrtm(c1)                                     # Whitened once for all frequencies
+    y_white = reference_whitening(data_ref)                         # (frequencies, samples, references)
     # --------------------------------- Transformed correlation matrix ---------------------------------------
-    eps = np.finfo(float).eps
-    r1 = np.eye(num_channel)
-    r2 = np.eye(2 * int(data_ref.shape[1] / 2))
-    r12 = np.real(np.linalg.inv(np.sqrt(c1) + eps * np.eye(c1.shape[0])) @ c12 @ np.linalg.inv(np.sqrt(c2) + 
-                  eps * np.eye(c2.shape[0])))
-    r21 = np.real(np.linalg.inv(np.sqrt(c2) + eps * np.eye(c2.shape[0])) @ c21 @ np.linalg.inv(np.sqrt(c1) + 
-                  eps * np.eye(c1.shape[0])))
-    r = np.vstack((np.hstack((r1, r12)), np.hstack((r21, r2))))
+    num_trial, num_sample, num_x = x_white.shape
+    num_freq, _, num_y = y_white.shape
+    # r12 of all trials and frequencies as a single matrix product
+    r12 = (np.swapaxes(x_white, 1, 2).reshape(-1, num_sample) @ 
+           np.moveaxis(y_white, 1, 0).reshape(num_sample, -1))
+    r12 = r12.reshape(num_trial, num_x, num_freq, num_y).transpose(0, 2, 1, 3) / (num_sample - 1)
+    r = np.zeros((num_trial, num_freq, num_x + num_y, num_x + num_y))
+    r[..., :num_x, num_x:] = r12
+    r[..., num_x:, :num_x] = np.swapaxes(r12, -1, -2)
+    r[..., np.arange(num_x + num_y), np.arange(num_x + num_y)] = 1
     # ------------------------------------- Eigenvalues of matrix --------------------------------------------
-    eig_vals, _ = np.linalg.eig(r)    # Landa
-    eig_vals[eig_vals < 0] = eps
-    eig_vals = np.real(eig_vals)
-    # landa = np.diag(landa)
-    eig_vals /= np.sum(eig_vals)     # Normalize eigenvalues
-
+    eig_vals = np.linalg.eigvalsh(r)                                # Landa, (trials, frequencies, P)
+    eig_vals = np.maximum(eig_vals, np.finfo(float).eps)
+    eig_vals /= np.sum(eig_vals, axis=-1, keepdims=True)            # Normalize eigenvalues
     # --------------------------- Synchronization index between two signals ----------------------------------
-    s = 1 + (np.sum(eig_vals * np.log(eig_vals)) / np.log(num_channel + 2 * int(data_ref.shape[1] / 2)))
-    
+    s = 1 + np.sum(eig_vals * np.log(eig_vals), axis=-1) / np.log(num_x + num_y)
+
     return s
 
+
+# ====================================== Reference signal whitening ==========================================
+def reference_whitening(data_ref):
+    """
+    Whitened reference signals Y c2^(-1/2) (centered), cached by content.
+    Parameters:
+    - data_ref: Reference signals with dimensions (number of frequencies, number of samples, number of
+    references) or (number of samples, number of references).
+    Output:
+    - y_white: Read-only whitened reference signals with the same dimensions (with a frequency axis).
+    """
+    data_ref = np.ascontiguousarray(data_ref, dtype=np.float64)
+    data_ref = data_ref[np.newaxis] if data_ref.ndim == 2 else data_ref
+
+    return _reference_whitening(data_ref.tobytes(), data_ref.shape)
+
+
+@lru_cache(maxsize=64)
+def _reference_whitening(buffer, shape):
+    y = np.frombuffer(buffer).reshape(shape)
+    y = y - np.mean(y, axis=1, keepdims=True)
+    y_white = y @ inv_sqrtm(np.swapaxes(y, 1, 2) @ y / (shape[1] - 1))
+    y_white.flags.writeable = False  # The cached signals are shared by every caller
+
+    return y_white
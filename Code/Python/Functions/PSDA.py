@@ -1,36 +1,37 @@
 import numpy as np
+from scipy import signal
+from functools import lru_cache
+from .Parallel import parallel_trials
 
 # ============================================== psda_analysis ===============================================
-def psda_analysis(data, f_stim, num_sample_neigh, fs, num_harmonic):
+def psda_analysis(data, f_stim, num_sample_neigh, fs, num_harmonic, method="fft", nfft=None, nperseg=None, 
+                  n_jobs=1, chunk_size=None, backend="process"):
     """
     =============================== Presented by: Reza Saadatyar (2023-2024) =================================
     ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
     Calculate the Power Spectral Density Amplitude (PSDA) for all trials.
     Inputs:
-        - data: EEG data matrix with dimensions (number of samples, number of channels).
+        - data: EEG data matrix with dimensions (number of samples, number of channels, number of trials).
         - f_stim: Array of frequencies of stimulation.
         - num_sample_neigh: Number of samples in the frequency neighborhood for each stimulation frequency.
         - fs: Sampling frequency.
         - num_harmonic: Number of harmonics for each stimulation frequency.
+        - method: Spectral estimator, 'fft', 'welch' or 'goertzel' (see psda_snr).
+        - nfft: Number of FFT points (zero-padding, default: number of samples).
+        - nperseg: Length of the Welch segments (default: half of the samples).
+        - n_jobs: Number of parallel workers over the trials (-1: all CPUs, default: 1).
+        - chunk_size: Number of trials of each chunk (default: the trials split evenly over the workers).
+        - backend: Workers of parallel_trials, 'process' (default) or 'thread'.
     Output:
-        - psda: Array containing the maximum PSDA values for each stimulation frequency.
+        - predict_label: Index of the stimulation frequency with the maximum PSDA for each trial.
     =============================== Flowchart for the psda_analysis function =================================
     Start
-    1. Convert data to ndarray if it's not already
-    2. Transpose the data if it has more columns than rows
-    3. Calculate the step size for the frequency neighborhood (step)
-    4. Create the frequency axis (f)
-    5. Initialize an array to store PSDA values (psda)
-    6. Loop over each stimulation frequency (f_stim):
-    a. Initialize a matrix to store PSD values for each channel (ps)
-    b. Loop over each channel in the EEG data:
-        i. Perform Fourier transform on the channel's data
-        ii. Compute power spectral density (psd)
-        iii. Loop over each harmonic:
-            - Find indices around stimulation frequency and frequency neighborhood
-            - Compute PSDA and store in the ps matrix
-    c. Store the maximum PSDA value for the current stimulation frequency in psda
-    Output: psda (Array containing the maximum PSDA values for each stimulation frequency)
+    1. Convert data to ndarray if it's not already and transpose it if it has more columns than rows.
+    2. Compute the PSDA of all trials, channels, stimulation frequencies and harmonics at once (psda_snr, with
+    the trials split over n_jobs workers).
+    3. Take the maximum PSDA over the channels and harmonics for each trial and stimulation frequency.
+    4. Predict the label of each trial as the stimulation frequency with the maximum PSDA.
+    Output: predict_label (Predicted label of each trial)
     End
     ==========================================================================================================
     """
@@ -39,40 +40,163 @@ def psda_analysis(data, f_stim, num_sample_neigh, fs, num_harmonic):
 
     # Transpose the data if it has more than one dimension and has fewer rows than columns
     data = data.T if data.ndim > 1 and data.shape[0] < data.shape[-1] else data
-    
-    # Number of frequency neighborhood for each stimulation frequency
-    step = fs * (num_sample_neigh / 2) / data.shape[0]
-    f = np.linspace(0, fs / 2, int(data.shape[0] / 2) + 1)  # Frequency axis
-
-    psda = np.zeros((len(f_stim), 1))  # Initialize array to store PSDA values
-    
-    predict_label = np.zeros(data.shape[-1])
-    
-    for ind in range(data.shape[-1]):
-        x = data[:, :, ind]
-
-        for i, val in enumerate(f_stim):  # Loop over each stimulation frequency
-            
-            # Initialize matrix to store PSD values for each channel
-            ps = np.zeros((x.shape[1], num_harmonic))  
-            
-            for j in range(x.shape[1]):  # Loop over each channel
-                x_fft = np.fft.fft(x[:, j], n=x[:, j].shape[0])  # Perform Fourier transform
-                x_fft = x_fft[:int(x[:, j].shape[0] / 2) + 1]  # Take one-sided spectrum
-                psd = np.abs(x_fft) ** 2  # Compute power spectral density
-
-                for h in range(1, num_harmonic + 1): # Loop over each harmonic
-                    # Find indices around stimulation frequency
-                    ind_fk = np.where((f >= h * val - 0.2) & (f <= h * val + 0.2))[0]
-                    # Find indices for frequency neighborhood
-                    ind_h = np.where((f >= h * val - step) & (f <= h * val + step))[0]
-
-                    # Compute PSDA and plot PSD in the neighborhood
-                    ps[j, h-1] = 10 * np.log10((num_sample_neigh * max(psd[ind_fk])) / (np.sum(psd[ind_h]) -
-                                                                                        max(psd[ind_fk])))
-            # Store maximum PSDA value for the current stimulation frequency
-            psda[i] = np.max(np.max(ps, axis=1)) 
-            
-        predict_label[ind] = np.argmax(psda)
-
-    return predict_label
+    # PSDA with dimensions (trials, channels, frequencies, harmonics)
+    snr = parallel_trials(psda_snr, data, f_stim, num_sample_neigh, fs, num_harmonic, method, nfft, nperseg, 
+                          n_jobs=n_jobs, chunk_size=chunk_size, backend=backend)
+    psda = np.max(snr, axis=(1, 3))                                     # (trials, frequencies)
+
+    return np.argmax(psda, axis=1).astype(float)
+
+
+# ================================================ PSDA (SNR) ================================================
+def psda_snr(data, f_stim, num_sample_neigh, fs, num_harmonic, method="fft", nfft=None, nperseg=None):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    PSDA of every trial, channel, stimulation frequency and harmonic from a single spectral estimate.
+    Inputs:
+        - data: EEG data matrix with dimensions (number of samples, number of channels, number of trials) or
+        (number of samples, number of channels) for a single trial.
+        - f_stim: Array of frequencies of stimulation.
+        - num_sample_neigh: Number of samples in the frequency neighborhood for each stimulation frequency.
+        - fs: Sampling frequency.
+        - num_harmonic: Number of harmonics for each stimulation frequency.
+        - method: Spectral estimator:
+            - 'fft': periodogram from a single (zero-padded) rfft of all channels and trials.
+            - 'welch': Welch averaged periodogram with a cached Hann window.
+            - 'goertzel': DFT evaluated only at the peak and neighborhood bins (same values as 'fft'), cheaper
+            than the full spectrum for short online windows.
+        - nfft: Number of FFT points (zero-padding, default: number of samples). The peak and neighborhood
+        windows keep their width in Hz, with nfft / number of samples times more bins.
+        - nperseg: Length of the Welch segments (default: half of the samples).
+    Output:
+        - snr: PSDA (dB) with dimensions (number of trials, number of channels, number of frequencies, number
+        of harmonics).
+    ================================= Flowchart for the psda_snr function ====================================
+    Start
+    1. Convert data to ndarray if it's not already and transpose it if it has more columns than rows.
+    2. Get the peak (+-0.2 Hz) and neighborhood (+-step) bin indices of every stimulation frequency and
+    harmonic from the cache (computed once per fs, samples, f_stim, harmonics, neighborhood and nfft).
+    3. Compute the power spectral density (psd) of all channels and trials in one call (power_spectrum), or
+    only at the bins of the tables for 'goertzel'.
+    4. Gather the psd at the peak and neighborhood bins and reduce them (maximum and sum).
+    5. Return PSDA = 10 log10(n * max(P(fk)) / (sum(P(neighborhood)) - max(P(fk)))), with n scaled by
+    nfft / number of samples.
+    End
+    ==========================================================================================================
+    """
+    # ------------------------ Convert data to ndarray if it's not already -----------------------------------
+    data = np.array(data) if not isinstance(data, np.ndarray) else data
+
+    # Transpose the data if it has more than one dimension and has fewer rows than columns
+    data = data.T if data.ndim > 1 and data.shape[0] < data.shape[-1] else data
+    data = data[:, :, np.newaxis] if data.ndim == 2 else data   # A single trial
+    nfft = nfft or data.shape[0]
+    ind_fk, ind_h, mask_h = psda_bins(fs, data.shape[0], f_stim, num_harmonic, num_sample_neigh, nfft)
+    # ------------------------------------- Power spectral density -------------------------------------------
+    if method == "goertzel":   # DFT at the bins of the tables only
+        basis, ind_fk, ind_h = _dft_basis(data.shape[0], nfft, ind_fk.tobytes(), ind_h.tobytes(), ind_h.shape)
+        psd = np.abs(np.tensordot(data, basis, axes=(0, 0))) ** 2
+    else:
+        psd = np.moveaxis(power_spectrum(data, fs, method, nfft, nperseg), 0, -1)
+    # ------------------------------------------ Gather and reduce -------------------------------------------
+    peak = np.max(psd[..., ind_fk], axis=-1)    # (channels, trials, frequencies, harmonics)
+    neigh = np.sum(psd[..., ind_h] * mask_h, axis=-1)
+    num_bin = num_sample_neigh * nfft / data.shape[0]   # num_sample_neigh without zero-padding
+    snr = 10 * np.log10(num_bin * peak / (neigh - peak))
+
+    return np.swapaxes(snr, 0, 1)
+
+
+# ============================================= Power spectrum ===============================================
+def power_spectrum(data, fs, method="fft", nfft=None, nperseg=None):
+    """
+    Power spectral density of all channels and trials along the time axis (axis 0).
+    Inputs:
+        - data: EEG data matrix with dimensions (number of samples, ...).
+        - fs: Sampling frequency.
+        - method: 'fft' (periodogram, |rfft|^2) or 'welch' (averaged periodogram with a Hann window).
+        - nfft: Number of FFT points (zero-padding, default: number of samples).
+        - nperseg: Length of the Welch segments (default: half of the samples).
+    Output:
+        - psd: One-sided power spectral density with dimensions (nfft // 2 + 1, ...), on the frequency axis
+        np.linspace(0, fs / 2, nfft // 2 + 1).
+    """
+    if method == "fft":
+        return np.abs(np.fft.rfft(data, n=nfft, axis=0)) ** 2
+    elif method == "welch":
+        nperseg, nfft = nperseg or data.shape[0] // 2, nfft or data.shape[0]   # Same frequency axis as 'fft'
+        return signal.welch(data, fs, window=_hann_window(nperseg), nperseg=nperseg, nfft=nfft, axis=0)[1]
+
+    raise ValueError(f"Unknown spectral estimator '{method}', expected 'fft', 'welch' or 'goertzel'")
+
+
+@lru_cache(maxsize=16)
+def _hann_window(nperseg):
+    window = signal.get_window("hann", nperseg)
+    window.flags.writeable = False  # The cached window is shared by every caller
+
+    return window
+
+
+@lru_cache(maxsize=64)
+def _dft_basis(num_sample, nfft, ind_fk, ind_h, shape):
+    # Complex exponentials of the bins used by the PSDA tables, and the tables remapped to those bins
+    ind_fk = np.frombuffer(ind_fk, dtype=np.intp).reshape(shape[:2] + (-1,))
+    ind_h = np.frombuffer(ind_h, dtype=np.intp).reshape(shape)
+    bins = np.unique(np.concatenate((ind_fk.ravel(), ind_h.ravel())))
+    basis = np.exp(-2j * np.pi * np.outer(np.arange(num_sample), bins) / nfft)   # (samples, bins)
+    basis.flags.writeable = False
+
+    return basis, np.searchsorted(bins, ind_fk), np.searchsorted(bins, ind_h)
+
+
+# =============================================== PSDA bins ==================================================
+def psda_bins(fs, num_sample, f_stim, num_harmonic, num_sample_neigh, nfft=None):
+    """
+    Peak and neighborhood bin indices of every stimulation frequency and harmonic, cached by their parameters
+    and shared by all the spectral estimators.
+    Inputs:
+        - fs: Sampling frequency.
+        - num_sample: Number of samples of the trials.
+        - f_stim: Array of frequencies of stimulation.
+        - num_harmonic: Number of harmonics for each stimulation frequency.
+        - num_sample_neigh: Number of samples in the frequency neighborhood for each stimulation frequency.
+        - nfft: Number of points of the spectrum (default: number of samples).
+    Outputs:
+        - ind_fk: Bins within +-0.2 Hz of each harmonic, padded by repeating the last bin, with dimensions
+        (number of frequencies, number of harmonics, widest window).
+        - ind_h: Bins within +-step of each harmonic, padded in the same way.
+        - mask_h: 1 for the bins of ind_h that belong to the neighborhood and 0 for the padding.
+    """
+    f_stim = tuple(float(val) for val in np.ravel(f_stim))
+
+    nfft = int(nfft or num_sample)
+
+    return _psda_bins(float(fs), int(num_sample), f_stim, int(num_harmonic), num_sample_neigh, nfft)
+
+
+@lru_cache(maxsize=64)
+def _psda_bins(fs, num_sample, f_stim, num_harmonic, num_sample_neigh, nfft):
+    step = fs * (num_sample_neigh / 2) / num_sample             # Frequency neighborhood of each stimulation
+    f = np.linspace(0, fs / 2, int(nfft / 2) + 1)               # Frequency axis
+    center = np.array(f_stim)[:, np.newaxis] * np.arange(1, num_harmonic + 1)
+
+    def window(half_width):
+        # The windows are contiguous because f is sorted: [lo, hi) matches f >= c - w & f <= c + w
+        lo = np.searchsorted(f, center - half_width, side="left")
+        hi = np.searchsorted(f, center + half_width, side="right")
+        if np.any(hi <= lo):
+            raise ValueError("No frequency bin around a harmonic of the stimulation frequencies (check fs, the "
+                             "number of samples and the number of harmonics)")
+        offset = np.arange(np.max(hi - lo))
+        ind = np.minimum(lo[..., np.newaxis] + offset, hi[..., np.newaxis] - 1)
+        mask = (offset < (hi - lo)[..., np.newaxis]).astype(float)
+        for val in (ind, mask):
+            val.flags.writeable = False  # The cached tables are shared by every caller
+        return ind, mask
+
+    ind_fk, _ = window(0.2)
+    ind_h, mask_h = window(step)
+
+    return ind_fk, ind_h, mask_h
@@ -2,7 +2,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 # ============================================ PSDA a trial ==================================================
-def psda_a_trial(data, fs, num_sample_neigh, f_stim, num_harmonic, title, fig_size=[4, 3]):
+def psda_a_trial(data, fs, num_sample_neigh, f_stim, num_harmonic, title, fig_size=[4, 3], nfft=None):
     """
     =============================== Presented by: Reza Saadatyar (2023-2024) =================================
     ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
@@ -13,6 +13,7 @@ def psda_a_trial(data, fs, num_sample_neigh, f_stim, num_harmonic, title, fig_si
       - num_sample_neigh: Number of samples in the neighborhood of each frequency stimulation.
       - f_stim: Array of frequencies for stimulation.
       - num_harmonic: Number of harmonic frequencies for each stimulation frequency.
+      - nfft: Number of FFT points (zero-padding for short windows, default: number of samples).
     Outputs:
       - max_freq: Maximum frequency found using PSDA.
       - label: Index of the stimulation frequency with maximum PSDA.
@@ -23,7 +24,7 @@ def psda_a_trial(data, fs, num_sample_neigh, f_stim, num_harmonic, title, fig_si
     3. Generate the frequency axis up to the Nyquist frequency.
     4. Calculate the frequency step size for each neighborhood.
     5. Initialize an array to store PSDA values for each stimulation frequency and harmonic.
-    6. Compute FFT of the data along the specified axis.
+    6. Compute the (zero-padded) FFT of the data along the specified axis.
     7. Take the one-sided spectrum of the FFT result.
     8. Compute the power spectral density (PSD) of the FFT result.
     9. Create a new figure with the specified size.
@@ -46,14 +47,15 @@ def psda_a_trial(data, fs, num_sample_neigh, f_stim, num_harmonic, title, fig_si
     # Transpose the data if it has more than one dimension and has fewer rows than columns
     data = data.T if data.ndim > 1 and data.shape[0] < data.shape[-1] else data
     
+    nfft = nfft or data.shape[0] # Number of FFT points
     # Generate frequency axis up to Nyquist frequency
-    f = np.linspace(0, fs/2, int(np.floor(data.shape[0]/2)) + 1) 
+    f = np.linspace(0, fs/2, int(np.floor(nfft/2)) + 1) 
     step = fs * (num_sample_neigh/2) / data.shape[0] # Calculate the frequency step size for each neighborhood
     # Initialize array to store PSDA values for each stimulation frequency and harmonic
     psda = np.zeros((len(f_stim), num_harmonic)) 
 
-    x_fft = np.fft.fft(data, axis=0) # Compute FFT of the data along the specified axis
-    x_fft = x_fft[:int(np.floor(data.shape[0]/2)) + 1] # Take one-sided spectrum
+    x_fft = np.fft.fft(data, n=nfft, axis=0) # Compute FFT of the data along the specified axis
+    x_fft = x_fft[:int(np.floor(nfft/2)) + 1] # Take one-sided spectrum
     psd = np.abs(x_fft)**2 # Compute power spectral density
     
     plt.figure(figsize=fig_size) # Create a new figure with the specified size
@@ -66,8 +68,9 @@ def psda_a_trial(data, fs, num_sample_neigh, f_stim, num_harmonic, title, fig_si
             ind_h = np.where((f >= h * val - step) & (f <= h * val + step))[0]
             
             # Compute PSDA and plot PSD in the neighborhood
-            psda[i, h-1] = 10 * np.log10((num_sample_neigh * max(psd[ind_fk])) / (np.sum(psd[ind_h]) - 
-                                                                                  max(psd[ind_fk])))
+            # (the neighborhood keeps its width in Hz, so it has nfft / number of samples times more points)
+            psda[i, h-1] = 10 * np.log10((num_sample_neigh * nfft / data.shape[0] * max(psd[ind_fk])) / 
+                                         (np.sum(psd[ind_h]) - max(psd[ind_fk])))
             plt.plot(f[ind_h], psd[ind_h], linewidth=2.5, label=f"F_stim{i + 1}.H{h}:{val * h}")
             
     # Find the maximum PSDA value and its corresponding label
@@ -0,0 +1,80 @@
+import os
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# ========================================= Parallel trial execution =========================================
+def parallel_trials(func, data, *args, n_jobs=1, chunk_size=None, backend="process", **kwargs):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Example:
+    cano_corr = parallel_trials(cca_batch, data, data_ref, num_channel, n_jobs=8)   % = cca_batch(data, ...)
+
+    PARALLEL_TRIALS runs func(data[..., trials], *args, **kwargs) on chunks of trials in parallel.
+    Parameters:
+    - func: Function of the trials along the last axis of data, returning an array with the trials along its
+    first axis (e.g., cca_batch, msi_batch, psda_snr). It must be defined at module level for backend
+    'process'.
+    - data: Data with the trials along the last axis, e.g., (number of samples, number of channels, number
+    of trials).
+    - *args, **kwargs: Other arguments of func (the same for every chunk).
+    - n_jobs: Number of workers (-1: all CPUs, 1: run func on the whole data in the calling process).
+    - chunk_size: Number of trials of each chunk (default: the trials split evenly over the workers).
+    - backend: 'process' (process pool, data shared through shared memory without pickling) or 'thread'
+    (thread pool, for functions spending their time in BLAS/LAPACK or FFT calls that release the GIL).
+    Output:
+    - result: Results of all chunks concatenated along the first axis, in the order of the trials.
+    ============================== Flowchart for the parallel_trials function ================================
+    Start
+    1. Run func on the whole data if there is a single worker or a single chunk.
+    2. Split the trials into contiguous chunks of chunk_size trials.
+    3. For backend 'process', copy data once into a shared memory block; the workers attach to it by name and
+    only receive the bounds of their chunk.
+    4. Map the chunks over the pool (results keep the order of the chunks).
+    5. Concatenate the results along the first axis and release the shared memory.
+    End
+    ==========================================================================================================
+    """
+    data = np.asarray(data)
+    num_trial = data.shape[-1]
+    n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 0 else max(1, int(n_jobs))
+    chunk_size = chunk_size or int(np.ceil(num_trial / n_jobs))
+    bounds = [(start, min(start + chunk_size, num_trial)) for start in range(0, num_trial, chunk_size)]
+
+    if n_jobs == 1 or len(bounds) < 2:
+        return func(data, *args, **kwargs)
+    n_jobs = min(n_jobs, len(bounds))
+
+    if backend == "thread":
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(lambda bound: func(data[..., bound[0]:bound[1]], *args, **kwargs), bounds))
+    elif backend == "process":
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        try:
+            np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[...] = data   # Single copy of the data
+            spec = (shm.name, data.shape, data.dtype.str)
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                futures = [pool.submit(_run_chunk, func, spec, bound, args, kwargs) for bound in bounds]
+                results = [future.result() for future in futures]
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        raise ValueError(f"Unknown backend '{backend}', expected 'process' or 'thread'")
+
+    return np.concatenate(results, axis=0)
+
+
+def _run_chunk(func, spec, bound, args, kwargs):
+    # Worker: attach to the shared data and run func on the trials of the chunk
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[..., bound[0]:bound[1]]
+        result = np.array(func(data, *args, **kwargs))   # Copy, the result must not point to the shared memory
+        del data                                         # Release the buffer before closing the block
+    finally:
+        shm.close()
+
+    return result
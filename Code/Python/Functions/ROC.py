@@ -1,10 +1,9 @@
 import numpy as np
-from sklearn import metrics
 import matplotlib.pyplot as plt
 
 # ============================================== Roc curve ===================================================
 def roc_curve(model, data_train=None, data_test=None, label_train=None, label_test=None, k_fold=None,
-              type_class=None, fig_size_Roc=(5, 3)):
+              type_class=None, fig_size_Roc=(5, 3), display_Roc_classes="on"):
     """
     ================================ Presented by: Reza Saadatyar (2023-2024) ================================
     ================================= E-mail: Reza.Saadatyar@outlook.com =====================================
@@ -16,8 +15,9 @@ def roc_curve(model, data_train=None, data_test=None, label_train=None, label_te
     - label_test: The labels corresponding to the test data.
     - k_fold: The fold number for cross-validation.
     - type_class: The type of classification.
-    - display_Roc_classes: Whether to display the ROC curves for each class.
     - fig_size_Roc: The size of the ROC curve plot.
+    - display_Roc_classes: Whether to display the ROC curves for each class ("on" or "off"; no figure is
+    created if "off").
 
     Outputs:
     - mean_tpr_tr: The mean true positive rate for the training data.
@@ -26,116 +26,173 @@ def roc_curve(model, data_train=None, data_test=None, label_train=None, label_te
     - mean_auc_te: The mean AUC for the test data.
     ================================== Flowchart for the Roc curve function ==================================
     1. Start.
-    2. Initialize lists and variables to store false positive rate (fpr), true positive rate (tpr), and ROC AUC
-       for each class and fold.
-    3. Binarize the labels for each class using one-hot encoding.
-    4. Predict the class probabilities for each class using the trained model.
-    5. Calculate the ROC curve for each class:
-        a. Compute fpr and tpr using metrics.roc_curve for both training and test data.
-        b. Calculate the area under the ROC curve (ROC AUC) for each class.
-    6. Calculate the mean true positive rate across all folds and classes.
-    7. Plot ROC curves for each class and compute macro-average and micro-average ROC curves:
-        a. Plot ROC curves for each class using fpr and tpr.
+    2. Predict the class probabilities of the training and/or test data using the trained model.
+    3. Compute the ROC curves and AUC of each class, and the macro-average and micro-average ROC curves and
+       AUC, without plotting (roc_engine).
+    4. If display_Roc_classes is "on", plot the ROC curves of each data set in its own axis (plot_roc):
+        a. Plot ROC curves for each class.
         b. Plot macro-average and micro-average ROC curves.
-        c. Compute ROC AUC for macro-average and micro-average curves.
-    8. Set axis limits, titles, labels, grid, and legend for the plots.
-    9. Return mean true positive rates and ROC AUC for training and test data.
-    10. End.
+        c. Set axis limits, titles, labels, grid, and legend for the plots.
+    5. Return mean true positive rates and ROC AUC for training and test data.
+    6. End.
     ==========================================================================================================
     """
     mean_tpr_tr, mean_tpr_te, mean_auc_tr, mean_auc_te = [], [], [], []
-    mean_fpr = np.linspace(0, 1, 100)
-    if data_train is not None and data_test is None:
-        fig1, ax1 = plt.subplots(nrows=1, ncols=1, figsize=fig_size_Roc, constrained_layout=True)
-    elif data_test is not None and data_train is None:
-        fig1, ax2 = plt.subplots(nrows=1, ncols=1, figsize=fig_size_Roc, constrained_layout=True)
-    else:
-        fig1, (ax1, ax2) = plt.subplots(nrows=1, ncols=2, figsize=fig_size_Roc, constrained_layout=True)
-    # ======================================== Section train model  ==========================================
-    # Initialize lists fpr, tpr, and roc_auc for each class
-    mean_tpr_tr, fpr_tr, tpr_tr, roc_auc_tr = 0.0, dict(), dict(), []
-    # -------------------------------- Binarize the labels for each class ------------------------------------
-    if data_train is not None:
-        num_classes = np.max(label_train) + 1
-        label_tr = np.eye(num_classes)[label_train]
-        y_scores_tr = model.predict_proba(data_train)   # Predict the labels for each class
-        for i in range(label_tr.shape[1]):              # ROC curve for each class 
-            fpr_tr[i], tpr_tr[i], _ = metrics.roc_curve(label_tr[:, i], y_scores_tr[:, i])
-            roc_auc_tr.append(metrics.auc(fpr_tr[i], tpr_tr[i]))
-            mean_tpr_tr += np.interp(mean_fpr, fpr_tr[i], tpr_tr[i]) # Interpolate the mean_tpr at mean_fpr
-            mean_tpr_tr[0] = 0.0
-            
-        mean_tpr_tr = mean_tpr_tr / (i+1) # Calculate mean true positive rate across all folds and classes
-        mean_auc_tr = metrics.auc(mean_fpr, mean_tpr_tr)
-        # Compute macro-average ROC curve and ROC area (First aggregate all false positive rates)
-        all_fpr_tr = np.unique(np.concatenate([fpr_tr[i] for i in range(label_tr.shape[1])]))
-        avg_tpr_tr = np.zeros_like(all_fpr_tr)        # Interpolate all ROC curves at this points
-        for i in range(label_tr.shape[1]):
-            avg_tpr_tr += np.interp(all_fpr_tr, fpr_tr[i], tpr_tr[i])
-            
-        avg_tpr_tr /= label_tr.shape[1]               # Finally average it and compute AUC
-        fpr_tr[i+1] = all_fpr_tr
-        tpr_tr[i+1] = avg_tpr_tr
-        roc_auc_tr.append(metrics.auc(fpr_tr[i+1], tpr_tr[i+1]))
-        # Compute micro-average ROC curve and ROC area 
-        fpr_tr[i+2], tpr_tr[i+2], _ = metrics.roc_curve(label_tr.ravel(), y_scores_tr.ravel())
-        roc_auc_tr.append(metrics.auc(fpr_tr[i+2], tpr_tr[i+2]))
-        
-        for i in range(label_tr.shape[1]):        # Plot ROC curve for each class 
-            ax1.plot(fpr_tr[i], tpr_tr[i], lw=1.2, label=f"Class {i}:{roc_auc_tr[i]:.2f}")
-            
-        ax1.plot([0, 1], [0, 1], linestyle='--', color='gray', lw=1.2) # Plot Macro avg & Micro avg 
-        ax1.plot(fpr_tr[i+1], tpr_tr[i+1] , color='blue', linestyle='-', lw=1.2, label=f"Macro avg:{roc_auc_tr[i+1]:.2f}")
-        ax1.plot(fpr_tr[i+2], tpr_tr[i+2] , color='g', linestyle='-', lw=1.2, label=f"Micro avg:{roc_auc_tr[i+2]:.2f}")
-        ax1.axis(xmin=-0.03, xmax=1, ymin=-0.03, ymax=1.03)    # Set x-axis and y-axis limits in a single line
-        ax1.set_title("Train model", fontsize=10, pad=0, loc="left")
-        ax1.grid(True, linestyle='--', which='major', color='grey', alpha=0.5, axis="y")
-        ax1.legend(title="AUC", loc='lower right',fontsize=9, ncol=1, frameon=True, labelcolor='linecolor', handlelength=0)
-        ax1.set_xlabel('False Positive Rate (FPR)', fontsize=10)
-        ax1.set_ylabel('True Positive Rate (TPR)', fontsize=10)
-    # ========================================= Section test model ===========================================
-    # Initialize lists fpr, tpr, and roc_auc for each class
-    mean_tpr_te, fpr_te, tpr_te, roc_auc_te = 0.0, dict(), dict(), []
-    # -------------------------------- Binarize the labels for each class ------------------------------------
-    if data_test is not None:
-        num_classes = np.max(label_test) + 1
-        label_te = np.eye(num_classes)[label_test]
-        y_scores_te = model.predict_proba(data_test)    # Predict the labels for each class
-        for i in range(label_tr.shape[1]):              # ROC curve for each class 
-            fpr_te[i], tpr_te[i], _ = metrics.roc_curve(label_te[:, i], y_scores_te[:, i])
-            roc_auc_te.append(metrics.auc(fpr_te[i], tpr_te[i]))
-            mean_tpr_te += np.interp(mean_fpr, fpr_te[i], tpr_te[i])  # Interpolate the mean_tpr at mean_fpr
-            mean_tpr_te[0] = 0.0
-            
-        mean_tpr_te = mean_tpr_te / (i+1) # Calculate mean true positive rate across all folds and classes
-        mean_auc_te = metrics.auc(mean_fpr, mean_tpr_te)
-        # Compute macro-average ROC curve and ROC area (First aggregate all false positive rates)
-        all_fpr_te = np.unique(np.concatenate([fpr_te[i] for i in range(label_te.shape[1])]))
-        avg_tpr_te = np.zeros_like(all_fpr_te)        # Interpolate all ROC curves at this points
-        for i in range(label_tr.shape[1]):
-            avg_tpr_te += np.interp(all_fpr_te, fpr_te[i], tpr_te[i])
-            
-        avg_tpr_te /= label_te.shape[1]               # Finally average it and compute AUC
-        fpr_te[i+1] = all_fpr_te
-        tpr_te[i+1] = avg_tpr_te
-        roc_auc_te.append(metrics.auc(fpr_te[i+1], tpr_te[i+1]))
-        # Compute micro-average ROC curve and ROC area
-        fpr_te[i+2], tpr_te[i+2], _ = metrics.roc_curve(label_te.ravel(), y_scores_te.ravel())
-        roc_auc_te.append(metrics.auc(fpr_te[i+2], tpr_te[i+2]))
-        
-        for i in range(label_tr.shape[1]):            #  Plot ROC curve for each class
-            ax2.plot(fpr_te[i], tpr_te[i], lw=1.2, label=f"Class {i}:{roc_auc_te[i]:.2f}")
-
-        ax2.plot([0, 1], [0, 1], linestyle='--', color='gray', lw=1.2) # Plot Macro avg & Micro avg 
-        ax2.plot(fpr_te[i+1], tpr_te[i+1] , color='blue', linestyle='-', lw=1.2, label=f"Macro avg:{roc_auc_te[i+1]:.2f}")
-        ax2.plot(fpr_te[i+2], tpr_te[i+2] , color='g', linestyle='-', lw=1.2, label=f"Micro avg:{roc_auc_te[i+2]:.2f}")
-        ax2.axis(xmin=-0.03, xmax=1, ymin=-0.03, ymax=1.03)     # Set x-axis and y-axis limits in a single line
-        ax2.set_title("Test model", fontsize=10, pad=0, loc="right")
-        ax2.set_xlabel('False Positive Rate (FPR)', fontsize=10)
-        ax2.grid(True, linestyle='--', which='major', color='grey', alpha=0.5, axis="y")
-        ax2.legend(title="AUC", loc='lower right',fontsize=9, ncol=1, frameon=True, labelcolor='linecolor', handlelength=0)
-
-    # plt.autoscale(axis="x", tight=True, enable=True)
-    fig1.suptitle(f"{type_class} ROC curve for the k-fold: {k_fold+1}", fontsize=10)
+    roc = {}
+    if data_train is not None:                                  # Section train model
+        roc["Train model"] = roc_engine(label_train, model.predict_proba(data_train))
+        mean_tpr_tr, mean_auc_tr = roc["Train model"]["macro_tpr"], roc["Train model"]["macro_auc"]
+    if data_test is not None:                                   # Section test model
+        roc["Test model"] = roc_engine(label_test, model.predict_proba(data_test))
+        mean_tpr_te, mean_auc_te = roc["Test model"]["macro_tpr"], roc["Test model"]["macro_auc"]
+    # ---------------------------------------------- Plotting ------------------------------------------------
+    if display_Roc_classes == "on" and roc:
+        fig1, axs = plt.subplots(nrows=1, ncols=len(roc), figsize=fig_size_Roc, constrained_layout=True)
+        for ax, (title, val), loc in zip(np.atleast_1d(axs), roc.items(), ["left", "right"]):
+            plot_roc(val, ax, title, loc if len(roc) > 1 else "left")
+        fold = f" for the k-fold: {k_fold+1}" if k_fold is not None else ""
+        fig1.suptitle(f"{type_class} ROC curve{fold}", fontsize=10)
 
     return mean_tpr_tr, mean_tpr_te, mean_auc_tr, mean_auc_te
+
+
+# ================================================ ROC engine ================================================
+def roc_engine(labels, scores, num_points=100):
+    """
+    ================================ Presented by: Reza Saadatyar (2023-2024) ================================
+    ================================= E-mail: Reza.Saadatyar@outlook.com =====================================
+    Example:
+    roc = roc_engine(labels, scores)   % labels: (folds, samples), scores: (folds, samples, classes)
+    auc_te = roc["macro_auc"]          % (folds,)
+
+    Headless multiclass ROC/AUC of one or many folds (or models) in a single vectorized pass (no plotting).
+    Inputs:
+    - labels: Class index (0, ..., number of classes - 1) of each sample, with dimensions (number of samples)
+    or (number of folds, number of samples). A list of folds of different lengths is padded (label -1 is
+    ignored).
+    - scores: Score of each class (e.g., predict_proba) with dimensions (number of samples, number of
+    classes) or (number of folds, number of samples, number of classes), or a list like labels.
+    - num_points: Number of points of the common false positive rate axis (default: 100).
+    Output:
+    - roc: Dictionary of arrays (without the fold axis for a single fold):
+        - "fpr": Common false positive rate axis np.linspace(0, 1, num_points).
+        - "tpr": True positive rate of each class on fpr (folds, classes, num_points).
+        - "auc": Exact AUC of each class (folds, classes), as metrics.roc_auc_score of one class vs the rest.
+        - "macro_tpr", "macro_auc": Mean of the class curves on fpr, starting at 0, and its AUC (folds, ...).
+        - "micro_tpr", "micro_auc": ROC of all the classes pooled together on fpr and its exact AUC.
+    ================================= Flowchart for the roc_engine function ==================================
+    1. Start.
+    2. Pad the folds to the same number of samples (if a list is given) and one-hot encode the labels.
+    3. Stack the one-vs-rest problem of every fold and class, and the pooled (micro) problem of every fold.
+    4. For all the problems at once: sort the scores, count the true and false positives cumulatively, and
+       give each group of equal scores the counts of its last sample (thresholds at the distinct scores).
+    5. Compute the exact AUC of each curve (trapezoidal rule) and interpolate the curves at the common false
+       positive rates with a single search over all the curves.
+    6. Average the class curves (macro) and return the arrays.
+    7. End.
+    ==========================================================================================================
+    """
+    single = np.ndim(scores[0]) == 1                    # A single fold: (samples, classes)
+    labels, scores, valid = _stack_folds(labels, scores)
+    num_fold, num_sample, num_class = scores.shape
+    one_hot = (labels[..., np.newaxis] == np.arange(num_class)) & valid[..., np.newaxis]
+    fpr = np.linspace(0, 1, num_points)
+    # ------------------------------ One-vs-rest problems of every fold and class ----------------------------
+    positive = np.swapaxes(one_hot, 1, 2).reshape(-1, num_sample)          # (folds * classes, samples)
+    tpr, auc = _roc_points(positive, np.swapaxes(scores, 1, 2).reshape(-1, num_sample),
+                           np.repeat(valid, num_class, axis=0), fpr)
+    tpr, auc = tpr.reshape(num_fold, num_class, -1), auc.reshape(num_fold, num_class)
+    # ---------------------------------- Pooled (micro) problem of every fold --------------------------------
+    micro_tpr, micro_auc = _roc_points(one_hot.reshape(num_fold, -1), scores.reshape(num_fold, -1),
+                                       np.repeat(valid, num_class, axis=1), fpr)
+    # ------------------------------------------------ Macro -------------------------------------------------
+    macro_tpr = np.mean(tpr, axis=1)
+    macro_tpr[:, 0] = 0.0
+    macro_auc = np.sum(np.diff(fpr) * (macro_tpr[:, 1:] + macro_tpr[:, :-1]) / 2, axis=-1)
+
+    roc = {"fpr": fpr, "tpr": tpr, "auc": auc, "macro_tpr": macro_tpr, "macro_auc": macro_auc,
+           "micro_tpr": micro_tpr, "micro_auc": micro_auc}
+    if single:                                          # Drop the fold axis
+        roc = {key: val if key == "fpr" else val[0] for key, val in roc.items()}
+
+    return roc
+
+
+def _stack_folds(labels, scores):
+    # Labels (folds, samples), scores (folds, samples, classes) and mask of the valid (not padded) samples
+    if isinstance(scores, (list, tuple)) and np.ndim(scores[0]) == 2:   # List of folds of different sizes
+        num_sample = max(len(val) for val in scores)
+        pad = [num_sample - len(val) for val in scores]
+        labels = np.array([np.pad(np.asarray(val), (0, num), constant_values=-1)
+                           for val, num in zip(labels, pad)])
+        scores = np.array([np.pad(np.asarray(val, dtype=float), ((0, num), (0, 0)), constant_values=-np.inf)
+                           for val, num in zip(scores, pad)])
+    labels, scores = np.asarray(labels, dtype=int), np.asarray(scores, dtype=float)
+    labels, scores = (labels[np.newaxis], scores[np.newaxis]) if scores.ndim == 2 else (labels, scores)
+
+    return labels, scores, labels >= 0
+
+
+def _roc_points(positive, scores, valid, fpr):
+    # ROC curves of the rows of positive/scores (problems, samples): tpr at fpr and exact AUC of each row
+    order = np.argsort(-np.where(valid, scores, -np.inf), axis=1, kind="stable")   # Decreasing scores
+    scores = np.take_along_axis(np.where(valid, scores, -np.inf), order, axis=1)
+    positive, valid = np.take_along_axis(positive, order, axis=1), np.take_along_axis(valid, order, axis=1)
+    tp, fp = np.cumsum(positive & valid, axis=1), np.cumsum(~positive & valid, axis=1)
+    # Equal scores share a threshold: every sample of a group takes the counts of the last one of the group
+    num_problem, num_sample = scores.shape
+    last = np.ones(scores.shape, dtype=bool)
+    last[:, :-1] = scores[:, 1:] != scores[:, :-1]
+    end = np.minimum.accumulate(np.where(last, np.arange(num_sample), num_sample)[:, ::-1], axis=1)[:, ::-1]
+    tp, fp = np.take_along_axis(tp, end, axis=1), np.take_along_axis(fp, end, axis=1)
+    tp, fp = np.pad(tp, ((0, 0), (1, 0))), np.pad(fp, ((0, 0), (1, 0)))   # Start at (0, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):   # Problems without positives or negatives: nan
+        x, y = fp / fp[:, -1:], tp / tp[:, -1:]
+    auc = np.sum(np.diff(x, axis=1) * (y[:, 1:] + y[:, :-1]) / 2, axis=1)
+    # --------------- Linear interpolation at fpr (as np.interp) of all the curves in one search -------------
+    offset = 2 * np.arange(num_problem)[:, np.newaxis]     # Curves shifted to disjoint intervals
+    xp = np.nan_to_num(x) + offset
+    ind = np.searchsorted(xp.ravel(), (fpr + offset).ravel(), side="right").reshape(num_problem, -1) - 1
+    ind = np.clip(ind - np.arange(num_problem)[:, np.newaxis] * x.shape[1], 0, x.shape[1] - 2)
+    x0, x1 = np.take_along_axis(x, ind, axis=1), np.take_along_axis(x, ind + 1, axis=1)
+    y0, y1 = np.take_along_axis(y, ind, axis=1), np.take_along_axis(y, ind + 1, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tpr = np.where(fpr >= x1, y1, y0 + (y1 - y0) / (x1 - x0) * (fpr - x0))
+
+    return tpr, auc
+
+
+# ================================================ Plot ROC ==================================================
+def plot_roc(roc, ax=None, title=None, loc="left", fig_size_Roc=(5, 3)):
+    """
+    Plot the ROC curves of a single fold from roc_engine: each class, macro-average and micro-average.
+    Inputs:
+    - roc: Output of roc_engine for a single fold (or one fold of it, e.g., {key: val[j] ...}).
+    - ax: Axis to plot on (default: a new figure).
+    - title: Title of the axis.
+    - loc: Location of the title ("left" or "right").
+    - fig_size_Roc: The size of the new figure (if ax is None).
+    Output:
+    - ax: The axis of the plot.
+    """
+    if ax is None:
+        _, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size_Roc, constrained_layout=True)
+    fpr = roc["fpr"]
+    for i in range(len(roc["auc"])):                           # Plot ROC curve for each class
+        ax.plot(fpr, roc["tpr"][i], lw=1.2, label=f"Class {i}:{roc['auc'][i]:.2f}")
+
+    ax.plot([0, 1], [0, 1], linestyle='--', color='gray', lw=1.2)  # Plot Macro avg & Micro avg
+    ax.plot(fpr, roc["macro_tpr"], color='blue', linestyle='-', lw=1.2,
+            label=f"Macro avg:{roc['macro_auc']:.2f}")
+    ax.plot(fpr, roc["micro_tpr"], color='g', linestyle='-', lw=1.2,
+            label=f"Micro avg:{roc['micro_auc']:.2f}")
+    ax.axis(xmin=-0.03, xmax=1, ymin=-0.03, ymax=1.03)         # Set x-axis and y-axis limits in a single line
+    ax.set_title(title, fontsize=10, pad=0, loc=loc)
+    ax.grid(True, linestyle='--', which='major', color='grey', alpha=0.5, axis="y")
+    ax.legend(title="AUC", loc='lower right', fontsize=9, ncol=1, frameon=True, labelcolor='linecolor',
+              handlelength=0)
+    ax.set_xlabel('False Positive Rate (FPR)', fontsize=10)
+    if loc == "left":
+        ax.set_ylabel('True Positive Rate (TPR)', fontsize=10)
+
+    return ax
@@ -0,0 +1,61 @@
+import numpy as np
+from functools import lru_cache
+from .Canonical_correlation import reference_qr
+
+# ============================================= Reference signal =============================================
+def reference_signal(fs, num_sample, f_stim, num_harmonic, phase=0, orthonormal=False, dtype=np.float64):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Sinusoidal reference signals for all stimulation frequencies, cached by their parameters.
+    Parameters:
+    - fs: Sampling frequency of the EEG data.
+    - num_sample: Number of samples of the window (trial length).
+    - f_stim: Array of frequencies for stimulation.
+    - num_harmonic: Number of harmonic frequencies for each stimulation frequency.
+    - phase: Initial phase (radians) of the stimulation, a scalar or one value for each stimulation frequency;
+    harmonic j uses j * phase (default: 0).
+    - orthonormal: If True, also return the orthonormal basis of the centered reference signals.
+    - dtype: Floating point precision of the orthonormal basis (np.float64 or np.float32).
+    Output:
+    - data_ref: Read-only array with dimensions (number of frequencies, number of samples, 2 * num_harmonic);
+    columns are sin(2*pi*j*f*t + j*phase), cos(2*pi*j*f*t + j*phase) for j = 1, ..., num_harmonic.
+    - q_ref: Read-only orthonormal basis with the same dimensions (only if orthonormal is True).
+    ============================== Flowchart for the reference_signal function ===============================
+    Start
+    1. Convert f_stim and phase to hashable tuples to build the cache key.
+    2. Look up the reference signals for (fs, num_sample, f_stim, num_harmonic, phase) in the LRU cache.
+    3. If not cached, generate all sine and cosine signals in a single vectorized expression.
+    4. If orthonormal is True, look up (or compute once) the QR basis of the centered reference signals.
+    5. Return the reference signals (and the orthonormal basis).
+    End
+    ==========================================================================================================
+    """
+    f_stim = tuple(float(val) for val in np.ravel(f_stim))
+    phase = tuple(float(val) for val in np.broadcast_to(phase, (len(f_stim),)))
+    key = (float(fs), int(num_sample), f_stim, int(num_harmonic), phase)
+
+    data_ref = _reference_signal(*key)
+    if orthonormal:
+        return data_ref, _reference_basis(*key, np.dtype(dtype).str)
+
+    return data_ref
+
+
+@lru_cache(maxsize=128)
+def _reference_signal(fs, num_sample, f_stim, num_harmonic, phase):
+    time = np.arange(num_sample) / fs                                # Time vector
+    harmonic = np.arange(1, num_harmonic + 1)
+    # Angle of every frequency stimulation and harmonic: (frequencies, samples, harmonics)
+    angle = harmonic * (2 * np.pi * np.outer(f_stim, time)[:, :, np.newaxis] + np.array(phase)[:, None, None])
+    data_ref = np.empty((len(f_stim), num_sample, 2 * num_harmonic))
+    data_ref[:, :, 0::2] = np.sin(angle)                             # Interleave sin/cos of each harmonic
+    data_ref[:, :, 1::2] = np.cos(angle)
+    data_ref.flags.writeable = False  # The cached reference signals are shared by every caller
+
+    return data_ref
+
+
+@lru_cache(maxsize=128)
+def _reference_basis(fs, num_sample, f_stim, num_harmonic, phase, dtype):
+    return reference_qr(_reference_signal(fs, num_sample, f_stim, num_harmonic, phase), dtype)
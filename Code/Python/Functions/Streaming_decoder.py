@@ -0,0 +1,171 @@
+import time
+import numpy as np
+from .Canonical_correlation import inv_sqrtm
+
+# ========================================== Streaming CCA decoder ===========================================
+class StreamingCCA:
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Real-time SSVEP decoder with a sliding-window, incremental CCA.
+    Parameters:
+    - fs: Sampling frequency of the EEG data.
+    - f_stim: Array of frequencies for stimulation.
+    - num_harmonic: Number of harmonic frequencies for each stimulation frequency.
+    - num_channel: Index of the channels to analyze (default: all channels).
+    - window_length: Length of the sliding window in seconds (rounded up to a whole number of hops).
+    - hop_length: Time between two decisions in seconds.
+    - pre_filter: Optional causal filter applied to every chunk (e.g., Filtering.StreamingFilter).
+    Usage:
+    - decoder = StreamingCCA(fs, f_stim, num_harmonic, num_channel, window_length=2, hop_length=0.25)
+    - decisions = decoder.update(chunk)  # chunk: (number of samples, number of channels), any size
+    ================================ Flowchart for the StreamingCCA decoder ==================================
+    Start
+    1. Filter the incoming samples with pre_filter (if given) and copy them into the current hop block
+    (preallocated) until it is full.
+    2. For each full block:
+        a. Generate the reference signals at the absolute time of the block.
+        b. Compute the block sums: x, y, x^T x, y^T y and x^T y (for every stimulation frequency).
+        c. Replace the oldest block of the ring buffer and update the running window sums.
+    3. Once the ring buffer covers the window, make a decision at every hop:
+        a. Build the covariance matrices of the window from the running sums.
+        b. Compute the canonical correlations of every frequency stimulation from the whitened covariances.
+        c. Return the sample index, the predicted label and the confidence (relative margin between the two
+        largest correlations).
+    End
+    ==========================================================================================================
+    """
+    def __init__(self, fs, f_stim, num_harmonic, num_channel=None, window_length=2, hop_length=0.25, 
+                 pre_filter=None):
+        self.fs = fs
+        self.f_stim = np.asarray(f_stim, dtype=float)
+        self.num_harmonic = num_harmonic
+        self.num_channel = num_channel
+        self.num_hop = max(1, int(round(hop_length * fs)))                        # Samples per hop
+        self.num_block = max(1, int(np.ceil(window_length * fs / self.num_hop)))  # Hops per window
+        self.pre_filter = pre_filter
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the buffers and the running statistics (e.g., at the start of a new run).
+        """
+        self.num_sample = 0   # Absolute index of the next sample
+        self.num_push = 0     # Number of blocks pushed into the ring buffer
+        self._fill = 0        # Number of samples in the current block
+        self._block = None
+        self._ring = None
+        self._total = None
+        if self.pre_filter is not None:
+            self.pre_filter.reset()
+
+    def update(self, chunk):
+        """
+        Feed a chunk of samples with dimensions (number of samples, number of channels).
+        Output:
+        - decisions: List of (sample index, predicted label, confidence) for every hop completed by this chunk.
+        """
+        chunk = np.asarray(chunk, dtype=float)
+        chunk = chunk[:, self.num_channel] if self.num_channel is not None else chunk
+        chunk = self.pre_filter.process(chunk) if self.pre_filter is not None else chunk
+        if self._block is None:
+            self._allocate(chunk.shape[1])
+
+        decisions = []
+        pos = 0
+        while pos < chunk.shape[0]:
+            # Copy as many samples as fit in the current block
+            take = min(self.num_hop - self._fill, chunk.shape[0] - pos)
+            self._block[self._fill:self._fill + take] = chunk[pos:pos + take]
+            self._fill += take
+            pos += take
+
+            if self._fill == self.num_hop:
+                self._push_block()
+                if self.num_push >= self.num_block:
+                    decisions.append(self._decide())
+
+        return decisions
+
+    # ---------------------------------------------- Internals -----------------------------------------------
+    def _allocate(self, num_x):
+        num_freq, num_y = len(self.f_stim), 2 * self.num_harmonic
+        shapes = {"n": (), "sx": (num_x,), "sxx": (num_x, num_x), "sy": (num_freq, num_y),
+                  "syy": (num_freq, num_y, num_y), "sxy": (num_freq, num_x, num_y)}
+        self._block = np.zeros((self.num_hop, num_x))
+        self._ring = {key: np.zeros((self.num_block,) + val) for key, val in shapes.items()}
+        self._total = {key: np.zeros(val) for key, val in shapes.items()}
+
+    def _reference(self, start):
+        time_block = (start + np.arange(self.num_hop)) / self.fs                    # Absolute time vector
+        harmonic = np.arange(1, self.num_harmonic + 1)
+        angle = 2 * np.pi * np.outer(self.f_stim, time_block)[:, :, np.newaxis] * harmonic
+        data_ref = np.empty(angle.shape[:2] + (2 * self.num_harmonic,))
+        data_ref[:, :, 0::2] = np.sin(angle)
+        data_ref[:, :, 1::2] = np.cos(angle)
+
+        return data_ref
+
+    def _push_block(self):
+        x = self._block
+        y = self._reference(self.num_sample)  # Reference signals at the absolute time of the block
+        stats = {"n": self.num_hop, "sx": np.sum(x, axis=0), "sxx": x.T @ x, "sy": np.sum(y, axis=1),
+                 "syy": np.swapaxes(y, 1, 2) @ y, "sxy": x.T[np.newaxis] @ y}
+        slot = self.num_push % self.num_block
+        for key, val in stats.items():
+            # Replace the oldest block and update the running window sums
+            self._total[key] += val - self._ring[key][slot]
+            self._ring[key][slot] = val
+
+        self.num_push += 1
+        self.num_sample += self.num_hop
+        self._fill = 0
+        if self.num_push % self.num_block == 0:  # Resynchronize the running sums to avoid rounding drift
+            self._total = {key: np.sum(val, axis=0) for key, val in self._ring.items()}
+
+    def _decide(self):
+        n = self._total["n"]
+        mx, my = self._total["sx"] / n, self._total["sy"] / n
+        cxx = self._total["sxx"] / n - np.outer(mx, mx)
+        cyy = self._total["syy"] / n - my[:, :, np.newaxis] * my[:, np.newaxis, :]
+        cxy = self._total["sxy"] / n - mx[np.newaxis, :, np.newaxis] * my[:, np.newaxis, :]
+        # Largest canonical correlation of every frequency stimulation
+        cano_corr = np.linalg.svd(inv_sqrtm(cxx)[np.newaxis] @ cxy @ inv_sqrtm(cyy), compute_uv=False)[:, 0]
+        cano_corr = np.clip(cano_corr, 0, 1)
+        label = int(np.argmax(cano_corr))
+        top = np.sort(cano_corr)[::-1]
+        confidence = (top[0] - top[1]) / top[0] if len(top) > 1 and top[0] > 0 else float(top[0])
+
+        return self.num_sample, label, float(confidence)
+
+
+# ================================================== Replay ==================================================
+def replay(decoder, data, chunk_size):
+    """
+    =============================== Presented by: Reza Saadatyar (2023-2024) =================================
+    ================================ E-mail: Reza.Saadatyar@outlook.com ======================================
+    Feed a recorded signal to a streaming decoder in chunks to test it offline.
+    Parameters:
+    - decoder: Streaming decoder with an update(chunk) method (e.g., StreamingCCA).
+    - data: Recorded EEG data with dimensions (number of samples, number of channels).
+    - chunk_size: Number of samples of each chunk.
+    Outputs:
+    - decisions: Array with dimensions (number of decisions, 3): sample index, predicted label, confidence.
+    - latency: Processing time (seconds) of each chunk.
+    ==========================================================================================================
+    """
+    # ----------------------------- Convert data to ndarray if it's not already ------------------------------
+    data = np.array(data) if not isinstance(data, np.ndarray) else data
+
+    # Transpose the data if it has more than one dimension and has fewer rows than columns
+    data = data.T if data.ndim > 1 and data.shape[0] < data.shape[-1] else data
+
+    starts = range(0, data.shape[0], chunk_size)
+    latency = np.zeros(len(starts))
+    decisions = []
+    for i, start in enumerate(starts):
+        time_start = time.perf_counter()
+        decisions.extend(decoder.update(data[start:start + chunk_size]))
+        latency[i] = time.perf_counter() - time_start
+
+    return np.array(decisions, dtype=float).reshape(-1, 3), latency
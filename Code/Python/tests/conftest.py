@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The functions are imported as the notebooks do: from Functions import ...
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,41 @@
+import numpy as np
+from Functions.CCA import cca
+from Functions.Canonical_correlation import cca_batch
+from Functions.Common_average_reference import car
+from Functions.Reference_signal import reference_signal
+
+FS, F_STIM, NUM_HARMONIC = 256, [8, 10, 12], 2
+
+
+def ssvep_data(num_trial=12, num_channel=6, num_sample=512, seed=0):
+    # Noisy trials with a weak SSVEP at one of the stimulation frequencies: (samples, channels, trials)
+    rng = np.random.default_rng(seed)
+    time = np.arange(num_sample) / FS
+    labels = rng.integers(0, len(F_STIM), num_trial)
+    data = rng.standard_normal((num_sample, num_channel, num_trial))
+    ssvep = np.sin(2 * np.pi * np.array(F_STIM)[labels] * time[:, np.newaxis])[:, np.newaxis, :]
+    data += 0.5 * ssvep * np.linspace(0, 1, num_channel)[:, np.newaxis]   # Not removed by CAR
+
+    return data, labels
+
+
+def test_cca_batch_common_average_reference_is_rank_truncated():
+    # CAR over all the channels removes one dimension: the last channel is a combination of the others
+    data_car = car(ssvep_data()[0])
+    data_ref = reference_signal(FS, data_car.shape[0], F_STIM, NUM_HARMONIC)
+
+    cano_corr = cca_batch(data_car, data_ref)                     # Rank-deficient trials
+    expected = cca_batch(data_car[:, :-1, :], data_ref)           # Same column space, full rank
+
+    np.testing.assert_allclose(cano_corr[..., :expected.shape[-1]], expected, atol=1e-10)
+    np.testing.assert_allclose(cano_corr[..., expected.shape[-1]:], 0, atol=1e-10)
+
+
+def test_cca_common_average_reference_labels():
+    data, labels = ssvep_data()
+    data_car = car(data)
+    predict_label = cca(data_car, FS, F_STIM, slice(None), NUM_HARMONIC)
+
+    np.testing.assert_array_equal(predict_label, cca(data_car[:, :-1, :], FS, F_STIM, slice(None),
+                                                     NUM_HARMONIC))
+    assert np.mean(predict_label == labels) > 0.9
@@ -0,0 +1,29 @@
+import numpy as np
+from Functions.FFT_Feature_Extraction import fft_feature_extraction
+
+FS, NUM_CHANNEL, SUBBANDS = 256, [0, 2, 3], ([6, 12, 20], [10, 18, 30])
+
+
+def baseline_fft_feature_extraction(data, fs, num_channel, subbands):
+    # Reference (baseline implementation): loop over the trials and the subbands
+    f = np.linspace(0, fs / 2, data.shape[0] // 2 + 1)
+    features = np.zeros((data.shape[-1], np.array(subbands).shape[1] * len(num_channel)))
+    for i in range(data.shape[-1]):
+        data_fft = np.fft.fft(data[:, num_channel, i], axis=0)
+        data_psd = np.abs(data_fft[:len(data_fft) // 2, :])
+        for ind_sb, (val_sb1, val_sb2) in enumerate(zip(*subbands)):
+            ind = np.where((f >= val_sb1) & (f <= val_sb2))[0]
+            features[i, ind_sb * len(num_channel):(ind_sb + 1) * len(num_channel)] = np.max(data_psd[ind, :],
+                                                                                        axis=0)
+    return features
+
+
+def test_fft_feature_extraction_matches_baseline_and_writes_into_out():
+    data = np.random.default_rng(0).standard_normal((512, 4, 6))   # (samples, channels, trials)
+    expected = baseline_fft_feature_extraction(data, FS, NUM_CHANNEL, SUBBANDS)
+
+    np.testing.assert_allclose(fft_feature_extraction(data, FS, NUM_CHANNEL, SUBBANDS), expected, rtol=1e-12)
+    out = np.full_like(expected, np.nan)
+    result = fft_feature_extraction(data, FS, NUM_CHANNEL, SUBBANDS, out=out)
+    assert result is out
+    np.testing.assert_allclose(out, expected, rtol=1e-12)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from scipy import signal
+from Functions.Filtering import filtering
+
+FS, F_LOW, F_HIGH, NOTCH_FREQ, QUALITY_FACTOR = 256, 6, 40, 50, 30
+
+
+def baseline_filtering(data, type_filter, order, design_method):
+    # Reference (baseline implementation): design on normalized frequencies, notch then filter with filtfilt
+    f_low, f_high = F_LOW / (FS / 2), F_HIGH / (FS / 2)
+    band = {"low": f_low, "high": f_high}.get(type_filter, [f_low, f_high])
+    if design_method == "IIR":
+        b, a = signal.butter(order, band, btype=type_filter)
+    else:
+        pass_zero = {"low": "lowpass", "high": "highpass"}.get(type_filter, type_filter)
+        b, a = signal.firwin(order, band, pass_zero=pass_zero), 1
+    filtered_data = signal.filtfilt(*signal.iirnotch(NOTCH_FREQ, QUALITY_FACTOR, FS), data)
+
+    return signal.filtfilt(b, a, filtered_data)
+
+
+@pytest.mark.parametrize("design_method", ["IIR", "FIR", "IRR"])   # "IRR" (default) goes down the FIR branch
+@pytest.mark.parametrize("type_filter", ["low", "high", "bandpass", "bandstop"])
+def test_filtering_matches_baseline(type_filter, design_method):
+    order = 3 if design_method == "IIR" else 31   # firwin needs an odd number of taps for high and bandstop
+    data = np.random.default_rng(0).standard_normal((4, 1000))   # (channels, samples)
+    expected = baseline_filtering(data, type_filter, order, "IIR" if design_method == "IIR" else "FIR")
+
+    result = filtering(data.T, F_LOW, F_HIGH, order, FS, NOTCH_FREQ, QUALITY_FACTOR, type_filter=type_filter,
+                       design_method=design_method)
+
+    np.testing.assert_allclose(result, expected.T, rtol=1e-7, atol=1e-10)
+
+
+@pytest.mark.parametrize("design_method", ["IIR", "FIR"])
+def test_filtering_out_block_by_block(design_method, monkeypatch):
+    monkeypatch.setattr("Functions.Filtering.NUM_BLOCK", 2500)   # Several blocks of trials
+    data = np.random.default_rng(1).standard_normal((500, 3, 7))   # (samples, channels, trials)
+    expected = filtering(data, F_LOW, F_HIGH, 5, FS, NOTCH_FREQ, QUALITY_FACTOR, design_method=design_method,
+                         axis=0)
+
+    out = np.empty_like(data)
+    result = filtering(data, F_LOW, F_HIGH, 5, FS, NOTCH_FREQ, QUALITY_FACTOR, design_method=design_method,
+                       axis=0, out=out)
+    assert result is out
+    np.testing.assert_allclose(out, expected, rtol=1e-12, atol=1e-12)
+
+    filtering(data, F_LOW, F_HIGH, 5, FS, NOTCH_FREQ, QUALITY_FACTOR, design_method=design_method, axis=0,
+              out=data)   # In place
+    np.testing.assert_allclose(data, expected, rtol=1e-12, atol=1e-12)
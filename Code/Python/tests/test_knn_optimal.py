@@ -0,0 +1,41 @@
+import numpy as np
+from sklearn import neighbors
+from Functions.Knn_optimal import knn_sweep
+
+N = 21
+
+
+def dataset(discrete, seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 3, (210, 3)) if discrete else rng.standard_normal((210, 3))
+    labels = rng.integers(0, 3, 210)
+    data = data + 0.8 * labels[:, np.newaxis]
+
+    return data[:150].astype(float), labels[:150], data[150:].astype(float), labels[150:]
+
+
+def reference_accuracy(data_train, label_train, data, labels, k):
+    # Independent per-k KNN: neighbors sorted by distance, then by training sample, majority vote
+    distance = np.sqrt(np.sum((data[:, np.newaxis, :] - data_train[np.newaxis]) ** 2, axis=-1))
+    ind = np.argsort(distance, axis=1, kind="stable")[:, :k]
+    predict = [np.argmax(np.bincount(label_train[val], minlength=3)) for val in ind]
+
+    return np.mean(np.array(predict) == labels)
+
+
+def test_knn_sweep_matches_sklearn_without_ties():
+    data_train, label_train, data_test, label_test = dataset(discrete=False)
+    accuracy = knn_sweep(data_train, label_train, [data_train, data_test], [label_train, label_test], N)
+
+    for data, labels, acc in zip([data_train, data_test], [label_train, label_test], accuracy):
+        model = [neighbors.KNeighborsClassifier(n_neighbors=k).fit(data_train, label_train) for k in range(1, N)]
+        expected = [val.score(data, labels) for val in model]
+        np.testing.assert_allclose(acc, expected)
+
+
+def test_knn_sweep_tied_distances_break_ties_by_training_sample():
+    data_train, label_train, data_test, label_test = dataset(discrete=True)
+    accuracy = knn_sweep(data_train, label_train, data_test, label_test, N)
+
+    expected = [reference_accuracy(data_train, label_train, data_test, label_test, k) for k in range(1, N)]
+    np.testing.assert_allclose(accuracy, expected)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from Functions.CCA import cca
+from Functions.MSI import msi
+from Functions.PSDA import psda_analysis
+from Functions.FoCCA import focca_correlation
+from Functions.FBCCA import fbcca_correlation
+from test_canonical_correlation import FS, F_STIM, NUM_HARMONIC, ssvep_data
+
+NUM_CHANNEL, FILTER_BANKS = [0, 2, 4, 5], ([6, 14], [40, 40])
+
+
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_classifiers_forward_chunk_size_and_backend(backend):
+    data = ssvep_data(num_trial=10)[0]
+    calls = {
+        "cca": lambda **kw: cca(data, FS, F_STIM, NUM_CHANNEL, NUM_HARMONIC, **kw),
+        "msi": lambda **kw: msi(data, FS, F_STIM, NUM_CHANNEL, NUM_HARMONIC, **kw),
+        "psda": lambda **kw: psda_analysis(data, F_STIM, 5, FS, NUM_HARMONIC, **kw),
+        "focca": lambda **kw: focca_correlation(data, FS, F_STIM, NUM_CHANNEL, NUM_HARMONIC, **kw),
+        "fbcca": lambda **kw: fbcca_correlation(data, FS, F_STIM, NUM_CHANNEL, NUM_HARMONIC, FILTER_BANKS, 4, 50,
+                                                30, **kw),
+    }
+    for name, call in calls.items():   # Chunks of 3 trials (4 chunks) over 2 workers
+        np.testing.assert_allclose(call(n_jobs=2, chunk_size=3, backend=backend), call(), atol=1e-12,
+                                   err_msg=name)